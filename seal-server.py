@@ -1,11 +1,23 @@
 #!/usr/bin/python
 
+import os
+import sys
 import time
+import errno
 import datetime
 import socket
 import select
+import signal
+import argparse
+import atexit
 import threading
+import collections
+import heapq
+import zlib
 import urlparse
+import email.utils
+import json
+import Queue
 
 # Global log level
 # 0: critical errors
@@ -14,19 +26,141 @@ import urlparse
 # 3: general information
 LOG_LEVEL = 3
 
-# Log device guard
-_log_lock = threading.Event()
-_log_lock.set()
+# Log device guard, for the lines written before a LogWriter is started
+_log_lock = threading.Lock()
+
+
+class LogWriter:
+    """ Writes log lines to a file from a background thread, so that handlers never wait
+    on console or disk I/O. Lines are queued in a deque, whose append and popleft don't
+    need a lock, and written in batches every interval seconds. When the queue holds
+    capacity lines further lines are dropped, past half of it sampled lines are only
+    kept one in SAMPLE.
+    """
+    SAMPLE = 10
+
+    def __init__(self, out, capacity=65536, interval=0.1):
+        self.out = out
+        self.capacity = capacity
+        self.interval = interval
+        self.lines = collections.deque()
+        self.written = 0
+        self.dropped = 0
+        self.sampled = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, line, sample=False):
+        """ Queue a line for writing, it must end with a new line.
+        :param sample: The line may be left out when the queue is filling up
+        """
+        queued = len(self.lines)
+        if queued >= self.capacity:
+            self.dropped += 1
+            return
+        if sample and queued >= self.capacity / 2:
+            self.sampled += 1
+            if self.sampled % LogWriter.SAMPLE:
+                return
+        self.lines.append(line)
+
+    def flush(self):
+        batch = []
+        try:
+            while True:
+                batch.append(self.lines.popleft())
+        except IndexError:
+            pass
+        if not batch:
+            return
+        try:
+            self.out.write("".join(batch))
+            self.out.flush()
+        except (IOError, ValueError):
+            pass
+        self.written += len(batch)
+
+    def stats(self):
+        return {"queued": len(self.lines), "written": self.written, "dropped": self.dropped, "sampled": self.sampled}
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+# Background writer of log(), None to write synchronously
+log_writer = None
+
+# Background writer of the access log, None if it's disabled
+access_log = None
+ACCESS_LOG_FORMAT = "text"
+
+# Formatted time of the current second, shared by all log lines within it
+_log_time = (0, "")
+
+
+def log_time():
+    global _log_time
+    now = int(time.time())
+    cached = _log_time
+    if cached[0] != now:
+        cached = _log_time = (now, datetime.datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S"))
+    return cached[1]
 
 
 def log(msg, prefix="[LOG]", level=3):
     """ Generates a log message. """
     if level > LOG_LEVEL:
         return
-    _log_lock.wait()
-    t = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(prefix + " [" + t + "] " + msg)
-    _log_lock.set()
+    line = prefix + " [" + log_time() + "] " + msg + "\n"
+    writer = log_writer
+    if writer is not None:
+        writer.put(line)
+        return
+    with _log_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+def log_access(client, method, host, status, count, duration):
+    """ Record a served request in the access log. """
+    if ACCESS_LOG_FORMAT == "json":
+        line = json.dumps({"time": log_time(), "client": client, "method": method, "host": host,
+                           "status": status, "bytes": count, "duration": round(duration, 6)}) + "\n"
+    else:
+        line = "%s %s %s %s %s %d %.3f\n" % (log_time(), client, method, host, status or "-", count, duration)
+    access_log.put(line, sample=True)
+
+
+def open_log(path):
+    """ Open a log file for appending, "-" stands for stdout. """
+    if path == "-":
+        return sys.stdout
+    return open(path, "a")
+
+
+def start_logging(opts):
+    """ Start the background log writers, again in a forked process. """
+    global log_writer, access_log, ACCESS_LOG_FORMAT
+    log_writer = LogWriter(open_log(opts.log_file), opts.log_queue)
+    access_log = None
+    if opts.access_log:
+        access_log = LogWriter(open_log(opts.access_log), opts.log_queue)
+        ACCESS_LOG_FORMAT = opts.access_log_format
+
+
+def exit_on_signal(signum, frame):
+    """ Exit right away on a signal like SIGTERM does by default, but flush the log first. """
+    flush_log()
+    os._exit(0)
+
+
+def flush_log():
+    for writer in (log_writer, access_log):
+        if writer is not None:
+            writer.flush()
 
 
 def hit(url):
@@ -53,42 +187,123 @@ def close_nothrow(sock):
 
 
 def forward_message_body(dst, msg, src):
+    # Multiple Transfer-Encoding's may be applied, but "chunked" must be the final one.
+    # Chunked coding overrides Content-Length, see RFC7230 Section 3.3.1 and 3.3.3
+    encoding = msg.get("Transfer-Encoding")
+    if encoding is not None and encoding.lower().endswith("chunked"):
+        dst.copy_chunks(src)
+        return True
+
     length = msg.get_int("Content-Length", -1)
     if length != -1:
         dst.copy_bytes(src, length)
         return True
-
-    # Multiple Transfer-Encoding's may be applied, but "chunked" must be the final one.
-    # See RFC7230 Section 3.3.1
-    encoding = msg.get("Transfer-Encoding")
-    if encoding.lower().endswith("chunked"):
-        dst.copy_chunks(src)
+    if msg.body_pending:
+        # A response body delimited by the end of the connection
+        dst.copy_until_close(src)
         return True
     return False
 
 
+def body_until_close(msg):
+    """ Test whether the pending body of a message ends only when its connection is closed.
+    See RFC7230 Section 3.3.3
+    """
+    if not msg.body_pending:
+        return False
+    encoding = msg.get("Transfer-Encoding")
+    if encoding is not None and encoding.lower().endswith("chunked"):
+        return False
+    return msg.get_int("Content-Length", -1) == -1
+
+
+def message_keep_alive(msg):
+    """ Test whether the connection a message was received from persists after it.
+    See RFC7230 Section 6.3
+    """
+    if body_until_close(msg):
+        return False
+    tokens = [t.strip(" \t").lower() for t in msg.get("Connection", "").split(",")]
+    if "close" in tokens:
+        return False
+    if msg.start_line.startswith("HTTP/1.0"):
+        return "keep-alive" in tokens
+    return True
+
+
+# Flag to send(2) telling more data follows, Linux only
+MSG_MORE = getattr(socket, "MSG_MORE", 0x8000 if sys.platform.startswith("linux") else 0)
+
+
 class IOException(Exception):
     def __init__(self, reason="Generic Error"):
         Exception.__init__(self, reason)
         self.reason = reason
 
 
+class TimeoutException(IOException):
+    """ A peer kept a connection waiting for longer than allowed.
+    :param kind: Which limit ran out, one of Timeouts.KINDS
+    """
+    def __init__(self, kind, reason):
+        IOException.__init__(self, reason)
+        self.kind = kind
+
+
+def wait_readable(conn, timeout):
+    """ Wait up to timeout seconds for conn to have data, or a hang up, to read.
+    :return: False if the time ran out
+    """
+    p = select.poll()
+    p.register(conn, select.POLLIN)
+    try:
+        return len(p.poll(max(timeout, 0) * 1000)) != 0
+    except select.error, e:
+        if e.args[0] == errno.EINTR:
+            # Let the caller receive, a blocking receive is still bound by the socket timeout
+            return True
+        raise
+
+
+def wait_writable(conn, timeout):
+    """ Wait up to timeout seconds for conn to accept more data.
+    :param timeout: None to wait without a limit
+    :return: False if the time ran out
+    """
+    p = select.poll()
+    p.register(conn, select.POLLOUT)
+    try:
+        return len(p.poll(-1 if timeout is None else max(timeout, 0) * 1000)) != 0
+    except select.error, e:
+        if e.args[0] == errno.EINTR:
+            return True
+        raise
+
+
 class HttpHeaders:
+    """ Header fields in wire order, duplicates included, indexed by lower cased key.
+    The index is built by the first lookup, a message that is only parsed and forwarded
+    never pays for it. A deleted field leaves a hole in fields, holes are squeezed out
+    lazily when fields are addressed by position.
+    """
     def __init__(self):
-        self.keys = []
-        self.values = []
+        self.fields = []    # (key, value) tuples, or None for a deleted field
+        self.index = None   # lower cased key -> ascending positions in fields
+        self.count = 0      # number of fields excluding holes
 
     def __len__(self):
-        return len(self.keys)
+        return self.count
+
+    def __iter__(self):
+        if self.count == len(self.fields):
+            return iter(self.fields)
+        return (f for f in self.fields if f is not None)
 
     def __contains__(self, item):
-        return isinstance(item, str) and self.find(item) != -1
+        return isinstance(item, str) and item.lower() in self._index()
 
     def __str__(self):
-        s = ""
-        for i in range(0, len(self.keys)):
-            s += self.keys[i] + ": " + self.values[i] + "\r\n"
-        return s
+        return "".join(self.serialize([]))
 
     def __getitem__(self, item):
         val = self.get(item)
@@ -99,60 +314,114 @@ class HttpHeaders:
     def __setitem__(self, key, value):
         return self.set(key, value)
 
+    def serialize(self, out):
+        """ Append the wire form of the header fields to the list out.
+        :return: out
+        """
+        out.extend(["%s: %s\r\n" % f for f in self.fields if f is not None])
+        return out
+
     def get(self, key, default_value=None):
-        key = key.lower()
-        for i in range(0, len(self.keys)):
-            if key == self.keys[i].lower():
-                return self.values[i]
-        return default_value
+        positions = self._index().get(key.lower())
+        if positions is None:
+            return default_value
+        return self.fields[positions[0]][1]
 
     def getall(self, key):
         """ Get all header values associated with the specified key.
         :return: A list of values that are associated with the key
         """
-        values = []
-        key = key.lower()
-        for i in range(0, len(self.keys)):
-            if key == self.keys[i].lower():
-                values.append(self.values[i])
-        return values
+        fields = self.fields
+        return [fields[i][1] for i in self._index().get(key.lower(), ())]
 
     def find(self, key, start=0):
-        key = key.lower()
-        if start > len(self.keys):
-            # out of range
-            return -1
-        for i in range(start, len(self.keys)):
-            if key == self.keys[i].lower():
+        # Positions are field numbers only when there's no hole
+        self._squeeze()
+        for i in self._index().get(key.lower(), ()):
+            if i >= start:
                 return i
         return -1
 
     def append(self, key, value):
-        self.keys.append(key)
-        self.values.append(value)
+        if self.index is not None:
+            positions = self.index.get(key.lower())
+            if positions is None:
+                self.index[key.lower()] = [len(self.fields)]
+            else:
+                positions.append(len(self.fields))
+        self.fields.append((key, value))
+        self.count += 1
+
+    def extend(self, fields):
+        """ Append a list of (key, value) tuples, the list is taken over. """
+        if len(self.fields):
+            for k, v in fields:
+                self.append(k, v)
+            return
+        self.fields = fields
+        self.count = len(fields)
+        self.index = None
 
     def set(self, key, value):
-        i = self.find(key)
-        if i != -1:
-            self.values[i] = value
-            # remove other values
-            self.delete(key, i + 1)
-        else:
+        positions = self._index().get(key.lower())
+        if positions is None:
             self.append(key, value)
+            return
+        self.fields[positions[0]] = (self.fields[positions[0]][0], value)
+        if len(positions) > 1:
+            # remove other values
+            for i in positions[1:]:
+                self.fields[i] = None
+            self.count -= len(positions) - 1
+            del positions[1:]
 
     def delete(self, key, start=0):
-        i = self.find(key, start)
-        while i != -1:
-            self.keys.pop(i)
-            self.values.pop(i)
-            i = self.find(key, i)
+        if start:
+            self._squeeze()
+        index = self._index()
+        positions = index.get(key.lower())
+        if positions is None:
+            return
+        kept = [i for i in positions if i < start]
+        for i in positions[len(kept):]:
+            self.fields[i] = None
+        self.count -= len(positions) - len(kept)
+        if kept:
+            index[key.lower()] = kept
+        else:
+            del index[key.lower()]
 
     def pop(self, i):
-        self.keys.pop(i)
-        self.values.pop(i)
+        self._squeeze()
+        self.fields[i] = None
+        self.count -= 1
+        self._squeeze()
 
     def at(self, i):
-        return self.keys[i], self.values[i]
+        self._squeeze()
+        return self.fields[i]
+
+    def _index(self):
+        if self.index is None:
+            # There's no hole, holes are only made while the index exists
+            index = {}
+            get = index.get
+            for i, (key, value) in enumerate(self.fields):
+                key = key.lower()
+                positions = get(key)
+                if positions is None:
+                    index[key] = [i]
+                else:
+                    positions.append(i)
+            self.index = index
+        return self.index
+
+    def _squeeze(self):
+        """ Remove holes so that positions in fields are the field numbers. """
+        if self.count == len(self.fields):
+            return
+        self.fields = [f for f in self.fields if f is not None]
+        self.index = None
 
 
 class HttpMessage:
@@ -170,12 +439,19 @@ class HttpMessage:
         self.body_pending = False
 
     def __str__(self):
-        s = self.start_line + "\r\n"
-        s += str(self.headers)
-        s += "\r\n"
-        if self.body is not None:
-            s += self.body
-        return s
+        return "".join(self.buffers())
+
+    def buffers(self):
+        """ Get the wire form of the message as a list of buffers to be written with
+        HttpOutputStream.writev, the body is not copied.
+        """
+        out = [self.start_line, "\r\n"]
+        self.headers.serialize(out)
+        out.append("\r\n")
+        head = "".join(out)
+        if self.body:
+            return [head, self.body]
+        return [head]
 
     def add(self, key, val):
         self.headers.append(key, val)
@@ -226,6 +502,7 @@ class HttpMessage:
 class HttpRequest(HttpMessage):
     def __init__(self):
         HttpMessage.__init__(self)
+        self.proxied = False    # sent to a parent proxy, the target is an absolute URI
 
     def __str__(self):
         return HttpMessage.__str__(self)
@@ -265,20 +542,145 @@ class HttpResponse(HttpMessage):
         return self.start_line[:a]
 
     def code(self):
-        a = self.start_line.find(" ")
-        a = ++a
-        while self.start_line[a] == ' ':
-            a = ++a
-        b = self.start_line.find(" ", a)
-        return int(self.start_line[a:b])
+        return int(self.start_line.split(None, 2)[1])
+
+    def bodyless(self):
+        """ Test whether the status never comes with a body, see RFC7230 Section 3.3.3. """
+        code = self.code()
+        return code < 200 or code == 204 or code == 304
 
     def phrase(self):
-        a = self.start_line.find(" ")
-        a = ++a
-        while self.start_line[a] == ' ':
-            a = ++a
-        b = self.start_line.find(" ", a)
-        return self.start_line[b+1:].strip(" \t")
+        parts = self.start_line.split(None, 2)
+        if len(parts) < 3:
+            return ""
+        return parts[2].strip(" \t")
+
+
+def parse_head(head, m):
+    """ Parse the header part of a message into m, folded field values are unfolded.
+    :param head: The start line and the header lines, without the final empty line
+    :return: A tuple of the framing of the body: (Content-Length or -1, whether chunked coding is applied)
+    """
+    lines = head.split("\r\n")
+    m.start_line = lines[0]
+    fields = []
+    length = -1
+    chunked = False
+    for line in lines[1:]:
+        if line[:1] in " \t":
+            # obs-fold, see RFC7230 Section 3.2.4
+            if not fields:
+                raise IOException("Bad header line: " + line)
+            k, v = fields[-1]
+            fields[-1] = (k, v + " " + line.strip(" \t"))
+            continue
+        p = line.find(":")
+        if p <= 0:
+            raise IOException("Bad header line: " + line)
+        fields.append((line[:p].strip(" \t"), line[p + 1:].strip(" \t")))
+
+    # Framing fields, checked after unfolding
+    for k, v in fields:
+        if k[0] not in "cCtT":
+            continue
+        k = k.lower()
+        if k == "content-length":
+            try:
+                length = int(v)
+            except ValueError:
+                raise IOException("Bad Content-Length: " + v)
+        elif k == "transfer-encoding":
+            # Multiple Transfer-Encoding's may be applied, but "chunked" must be the final one.
+            # See RFC7230 Section 3.3.1
+            chunked = v.lower().endswith("chunked")
+
+    m.headers.extend(fields)
+    return length, chunked
+
+
+class BufferPool:
+    """ Fixed size bytearray slabs that streams and tunnels borrow and give back, so that
+    connections coming and going reuse their buffers instead of keeping the allocator busy.
+    Slabs come in power of two sizes from MIN_SLAB to MAX_SLAB, a request gets the smallest
+    slab that fits, larger ones aren't pooled. At most limit bytes of slabs given back are
+    kept for reuse, the others are left to the garbage collector.
+    A slab must not be used once it has been given back, views of it included.
+    """
+    MIN_SLAB = 16 * 1024
+    MAX_SLAB = 1024 * 1024
+
+    def __init__(self, limit=64 * 1024 * 1024):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.free = {}          # slab size -> slabs ready for reuse, the last given back on top
+        self.idle = 0           # bytes of slabs in free
+        self.lent = 0           # bytes of slabs borrowed and not given back
+        self.idle_high = 0
+        self.lent_high = 0
+        self.hits = 0           # borrowed slabs that were reused
+        self.misses = 0         # borrowed slabs that had to be allocated
+        self.dropped = 0        # slabs given back beyond limit
+        self.shrunk = 0         # slabs given back by idle connections
+
+    @staticmethod
+    def slab_size(n):
+        size = BufferPool.MIN_SLAB
+        while size < n:
+            size *= 2
+        return size
+
+    def get(self, n):
+        """ Borrow a slab of at least n bytes, its content is undefined. """
+        size = BufferPool.slab_size(n)
+        if size > BufferPool.MAX_SLAB:
+            return bytearray(n)
+        with self.lock:
+            self.lent += size
+            self.lent_high = max(self.lent_high, self.lent)
+            slabs = self.free.get(size)
+            if slabs:
+                self.hits += 1
+                self.idle -= size
+                return slabs.pop()
+            self.misses += 1
+        return bytearray(size)
+
+    def put(self, slab, idle=False):
+        """ Give back a slab borrowed by get.
+        :param idle: Given back by a connection waiting for more, see HttpInputStream.release
+        """
+        size = len(slab)
+        if size > BufferPool.MAX_SLAB or size != BufferPool.slab_size(size):
+            return
+        with self.lock:
+            self.lent -= size
+            if idle:
+                self.shrunk += 1
+            if self.idle + size > self.limit:
+                self.dropped += 1
+                return
+            self.free.setdefault(size, []).append(slab)
+            self.idle += size
+            self.idle_high = max(self.idle_high, self.idle)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "idle": self.idle,
+                "idle_high": self.idle_high,
+                "lent": self.lent,
+                "lent_high": self.lent_high,
+                "slabs": sum([len(slabs) for slabs in self.free.values()]),
+                "hits": self.hits,
+                "misses": self.misses,
+                "dropped": self.dropped,
+                "shrunk": self.shrunk,
+            }
+
+
+# Read buffers of streams and copy buffers of tunnels
+buffer_pool = BufferPool()
 
 
 class HttpInputStream:
@@ -286,32 +688,100 @@ class HttpInputStream:
      can be either HTTP request stream for an HTTP server or an HTTP
      response stream for an HTTP client.
     """
-    def __init__(self, conn=None):
+    EMPTY = bytearray()
+
+    def __init__(self, conn=None, bufsize=16 * 1024, max_header=64 * 1024):
         self.conn = conn                # socket connection
-        self.rdbuf = ""                 # read buffer
-        self.maxrdbuf = 128 * 1024      # max size of read buffer, 128KB by default.
+        self.bufsize = bufsize          # initial size of read buffer
+        self.maxrdbuf = max(128 * 1024, max_header)  # max size of read buffer, 128KB by default.
+        self.max_header = max_header    # max size of a message header part
+        self.rdbuf = HttpInputStream.EMPTY  # read buffer borrowed from buffer_pool on the first receive,
+                                        # grows on demand up to maxrdbuf
+        self.rpos = 0                   # read cursor, start of the unread data
+        self.wpos = 0                   # write cursor, end of the unread data
+        self.header_timeout = None      # seconds the rest of a header part may take after its first bytes
 
     def attach(self, conn):
         self.conn = conn
-        self.rdbuf = ""
+        self.rpos = self.wpos = 0
 
-    def wait(self):
+    def buffered(self):
+        """ Get the number of bytes received but not read yet. """
+        return self.wpos - self.rpos
+
+    def wait(self, until_close=False):
         """ Wait for data input.
         This method does nothing and returns immediately if the read buffer is not empty.
+        :param until_close: The peer closing the connection is expected, not an error
+        :return: False if the peer has closed the connection and nothing is buffered
         """
-        if len(self.rdbuf):
-            return
+        if self.rpos != self.wpos:
+            return True
+        self.rpos = self.wpos = 0
+        return self._fill(until_close=until_close)
+
+    def _fill(self, deadline=None, until_close=False):
+        """ Receive more data after the unread data, making room for it first if needed.
+        A receive waits as long as the socket timeout allows, and no later than deadline if given.
+        :return: False if the peer has closed the connection and until_close is set
+        """
+        if self.wpos == len(self.rdbuf):
+            if not len(self.rdbuf):
+                self.rdbuf = buffer_pool.get(self.bufsize)
+            elif self.rpos:
+                self._compact()
+            elif len(self.rdbuf) < self.maxrdbuf:
+                self._grow(min(len(self.rdbuf) * 2, self.maxrdbuf))
+            else:
+                raise IOException("Read buffer is full.")
+        if deadline is not None and not wait_readable(self.conn, deadline - time.time()):
+            raise TimeoutException("header", "Message header not received within %gs." % self.header_timeout)
         try:
-            self.rdbuf = self.conn.recv(self.maxrdbuf)
+            n = self.conn.recv_into(memoryview(self.rdbuf)[self.wpos:])
+        except socket.timeout:
+            raise TimeoutException("body", "Connection stalled for %gs." % self.conn.gettimeout())
         except:
             raise IOException("Connection reset.")
-        if len(self.rdbuf) == 0:
+        if n == 0:
+            if until_close:
+                return False
             raise IOException("Connection closed.")
+        self.wpos += n
+        return True
+
+    def _compact(self):
+        # Move the unread data to the front of the buffer
+        n = self.wpos - self.rpos
+        self.rdbuf[0:n] = memoryview(self.rdbuf)[self.rpos:self.wpos]
+        self.rpos, self.wpos = 0, n
+
+    def _grow(self, size):
+        buf = buffer_pool.get(size)
+        n = self.wpos - self.rpos
+        buf[0:n] = memoryview(self.rdbuf)[self.rpos:self.wpos]
+        buffer_pool.put(self.rdbuf)
+        self.rdbuf = buf
+        self.rpos, self.wpos = 0, n
+
+    def release(self, idle=False):
+        """ Give the read buffer back to buffer_pool, what is buffered is dropped. The next
+        receive borrows a buffer again.
+        :param idle: The connection waits for its next message with nothing buffered
+        """
+        if not len(self.rdbuf):
+            return
+        buffer_pool.put(self.rdbuf, idle)
+        self.rdbuf = HttpInputStream.EMPTY
+        self.rpos = self.wpos = 0
 
     def read_some(self, max):
+        """ Read at most max bytes from the stream, waiting only if nothing is buffered.
+        :return: A memoryview into the read buffer, which is valid until the next read.
+        """
         self.wait()
-        r = self.rdbuf[:max]
-        self.rdbuf = self.rdbuf[max:]
+        n = min(max, self.wpos - self.rpos)
+        r = memoryview(self.rdbuf)[self.rpos:self.rpos + n]
+        self.rpos += n
         return r
 
     def read(self, n):
@@ -319,97 +789,186 @@ class HttpInputStream:
         :param n: Number of bytes to read
         :return: A string that contains the data read.
         """
-        r = ""
-        while len(r) < n:
-            self.wait()
-
-            a = n - len(r)
-            if a < len(self.rdbuf):
-                a = len(self.rdbuf)
-            r += self.rdbuf[:a]
-            self.rdbuf = self.rdbuf[a:]
-        return r
+        parts = []
+        while n:
+            d = self.read_some(n)
+            parts.append(d.tobytes())
+            n -= len(d)
+        if len(parts) == 1:
+            return parts[0]
+        return "".join(parts)
 
     def read_line(self):
         """ Read a line from the stream using CRLF as line ending.
         :return: A string that contains the data read.
         """
-        r = ""
-        crlf_pos = -1
-        while crlf_pos == -1:
-            if len(r) >= self.maxrdbuf:
+        self.wait()
+        scanned = self.rpos
+        while True:
+            crlf_pos = self.rdbuf.find("\r\n", scanned, self.wpos)
+            if crlf_pos != -1:
+                break
+            if self.wpos - self.rpos >= self.maxrdbuf:
                 raise IOException("read_line run out of buffer")
+            # Don't scan again what has been scanned, except a CR that may be followed by LF
+            scanned = max(self.wpos - 1, self.rpos) - self.rpos
+            self._fill()
+            scanned += self.rpos
+        r = memoryview(self.rdbuf)[self.rpos:crlf_pos].tobytes()
+        self.rpos = crlf_pos + 2
+        return r
 
-            self.wait()
-            crlf_pos = self.rdbuf.find("\r\n")
-            if crlf_pos != -1:
-                r += self.rdbuf[:crlf_pos]
-                self.rdbuf = self.rdbuf[crlf_pos + 2:]
-            else:
-                r += self.rdbuf
-                self.rdbuf = ""
+    def has_message(self):
+        """ Test whether the header part of a message is buffered, it can be read without waiting. """
+        pos = self.rpos
+        while self.rdbuf.startswith("\r\n", pos, self.wpos):
+            pos += 2
+        return self.rdbuf.find("\r\n\r\n", pos, self.wpos) != -1
+
+    def read_chunks(self):
+        """ Read the chunks of a chunked body that are buffered, without decoding them.
+        The chunk framing is scanned in place, see RFC7230 Section 4.1.
+        :return: A tuple (data, rest, last). data is a memoryview of whole chunks, possibly followed
+         by the beginning of a chunk whose rest bytes are still to be read. last tells whether data
+         ends with the last chunk and the trailer part. data is valid until the next read.
+        """
+        self.wait()
+        while True:
+            # A fill may have replaced the buffer
+            buf = self.rdbuf
+            pos, end = self.rpos, self.wpos
+            while True:
+                crlf = buf.find("\r\n", pos, end)
+                if crlf == -1:
+                    break
+                size = str(buf[pos:crlf]).split(";", 1)[0].strip(" \t")
+                try:
+                    size = int(size, 16)
+                except ValueError:
+                    raise IOException("Bad chunk size: " + size)
+                if size <= 0:
+                    if size < 0:
+                        raise IOException("Bad chunk size: " + str(size))
+                    # The last chunk, then trailer fields up to an empty line
+                    stop = buf.find("\r\n\r\n", crlf, end)
+                    if stop == -1:
+                        break
+                    return self._take(stop + 4), 0, True
+                stop = crlf + size + 4
+                if stop > end:
+                    return self._take(end), stop - end, False
+                if buf[stop - 2:stop] != "\r\n":
+                    raise IOException("Chunk data is not followed by CRLF")
+                pos = stop
+            if pos != self.rpos:
+                return self._take(pos), 0, False
+            if self.wpos - self.rpos >= self.maxrdbuf:
+                raise IOException("Chunk header or trailer part is too large")
+            self._fill()
+
+    def _take(self, pos):
+        # Consume the buffered data up to pos
+        r = memoryview(self.rdbuf)[self.rpos:pos]
+        self.rpos = pos
         return r
 
-    def read_message(self, m):
+    def read_message(self, m, no_body=False, until_close=True):
         """ Read an HTTP message from stream.
-        An IOException is raised if the size of the header part of incoming message is larger than maxrdbuf.
+        An IOException is raised if the header part of incoming message is larger than max_header.
         Only when the incoming message carries a Content-Length header and Content-Length <= maxrdbuf, the message body
          will be fully copied to body field.
         Otherwise, body_pending field will be set True and the message body should be read manually later.
+        :param no_body: The message has no body whatever its header says, e.g. a response to HEAD
+        :param until_close: A message without Content-Length or chunked coding has a body delimited by
+         the end of the connection, otherwise it has no body. See RFC7230 Section 3.3.3
         """
-        m.start_line = self.read_line()
-
-        prev_line = ""
-        curr_line = self.read_line()
-        while len(curr_line):
-            if curr_line[0] in " \t":
-                # folded header field value
-                prev_line += curr_line.strip(" \t")
-            else:
-                if len(prev_line):
-                    m.add_header_line(prev_line)
-                prev_line = curr_line
-            curr_line = self.read_line()
-
-        if len(prev_line):
-            m.add_header_line(prev_line)
+        head = self._read_head()
+        length, chunked = parse_head(head, m)
 
-        # Read message body if the size of body is explicitly told and is under buffer size limit
         m.body = ""
-        body_size = m.get_int("Content-Length", -1)
-        if 0 <= body_size <= self.maxrdbuf:
-            m.body = self.read(body_size)
-            m.body_pending = False
+        m.body_pending = False
+        if no_body or (isinstance(m, HttpResponse) and m.bodyless()):
+            return m
+        if chunked:
+            m.body_pending = True
+        elif length < 0:
+            m.body_pending = until_close
+        elif length <= self.maxrdbuf:
+            # Read message body if the size of body is explicitly told and is under buffer size limit
+            m.body = self.read(length)
         else:
-            # To be determined
             m.body_pending = True
         return m
 
+    def _read_head(self):
+        """ Read the header part of a message, up to the empty line that ends it.
+        The buffered bytes are scanned as they come, a scan resumes where the previous one
+        stopped. Empty lines before the start line are skipped, see RFC7230 Section 3.5.
+        Once the first bytes are in, the rest must arrive within header_timeout.
+        :return: A string of the start line and header lines, without the final empty line
+        """
+        self.wait()
+        deadline = None
+        if self.header_timeout is not None:
+            deadline = time.time() + self.header_timeout
+        while self.rdbuf[self.rpos] == 13:      # CR
+            if self.wpos - self.rpos < 2:
+                self._fill(deadline)
+            elif self.rdbuf[self.rpos + 1] == 10:
+                self.rpos += 2
+                self.wait()
+            else:
+                break
+        scanned = self.rpos
+        while True:
+            end = self.rdbuf.find("\r\n\r\n", scanned, self.wpos)
+            if end != -1:
+                break
+            if self.wpos - self.rpos >= self.max_header:
+                raise IOException("Message header is larger than %d bytes" % self.max_header)
+            # Don't scan again what has been scanned, except a partial CRLFCRLF
+            scanned = max(self.wpos - 3, self.rpos) - self.rpos
+            self._fill(deadline)
+            scanned += self.rpos
+        if end - self.rpos > self.max_header:
+            raise IOException("Message header is larger than %d bytes" % self.max_header)
+        head = memoryview(self.rdbuf)[self.rpos:end].tobytes()
+        self.rpos = end + 4
+        return head
+
     def read_request(self):
         r = HttpRequest()
-        self.read_message(r)
-        if r.method() in ["GET", "HEAD", "DELETE", "CONNECT", "TRACE"]:
-            # Those method may not has payload
-            r.body_pending = False
-        else:  # POST, PUT, OPTIONS
-            r.body_pending = True
-        return r
+        # A request without Content-Length or chunked coding has no body
+        return self.read_message(r, until_close=False)
 
-    def read_response(self):
+    def read_response(self, method=None):
+        """ Read a response to a request of method. """
         r = HttpResponse()
-        self.read_message(r)
-        return r
+        return self.read_message(r, no_body=method == "HEAD")
 
     def close(self):
         try:
             self.conn.shutdown(socket.SHUT_RD)
         except Exception:
             pass
+        self.release()
 
 
 class HttpOutputStream:
+    IOV_MAX = 1024
+    JOIN_LIMIT = 16 * 1024
+
     def __init__(self, conn):
         self.conn = conn
+        self.sent = 0       # bytes written
+        self.client = None  # address of the client the writes are shaped for, None if not shaped
+
+    def pace(self, n):
+        """ Charge n bytes written against the rate limits of the client, hold back if it
+        has run too far into debt. See Shaper. """
+        wait = shaper.take(self.client, n)
+        if wait:
+            time.sleep(wait)
 
     def copy_bytes(self, src, count):
         """ Copy count bytes from src to output. """
@@ -420,30 +979,69 @@ class HttpOutputStream:
             copied += len(d)
 
     def copy_chunks(self, src):
-        """ Copy chunks from src to output. See RFC7320 Section 4.1 """
+        """ Copy chunks from src to output. See RFC7320 Section 4.1
+        The chunks are passed through as received, a run of buffered chunks goes in one write.
+        """
         while True:
-            chunk_header = src.read_line()
-            chunk_size = int(chunk_header.strip(" \t").split(' ', 1)[0], 16)
-            if chunk_size <= 0:
-                break
-            self.write(chunk_header + "\r\n")
-            self.copy_bytes(src, chunk_size + 2)
-        self.write("0\r\n")
+            data, rest, last = src.read_chunks()
+            self.write(data)
+            if rest:
+                self.copy_bytes(src, rest)
+            if last:
+                return
 
-        # trailer-part
-        trailer_line = src.read_line()
-        while len(trailer_line):
-            self.write(trailer_line + "\r\n")
-            trailer_line = src.read_line()
-        self.write("\r\n")
+    def copy_until_close(self, src):
+        """ Copy everything from src to output until the peer of src closes the connection. """
+        while src.wait(until_close=True):
+            self.write(src.read_some(src.buffered()))
 
-    def write(self, data):
-        written = 0
-        while written != len(data):
-            count = self.conn.send(data[written:])
+    def write(self, data, flags=0):
+        if self.client is not None:
+            self.pace(len(data))
+        count = self.conn.send(data, flags)
+        if count != len(data):
+            # Partial write, go on with a view instead of copying the remaining data
+            view = memoryview(data)
+            while True:
+                if count <= 0:
+                    raise IOException("Connection closed before write complete.")
+                view = view[count:]
+                if not len(view):
+                    break
+                count = self.conn.send(view, flags)
+        self.sent += len(data)
+
+    def writev(self, buffers):
+        """ Write a list of buffers as a whole, without concatenating them.
+        The buffers are gathered by sendmsg if the socket supports it, otherwise sent one by
+        one with MSG_MORE set on all but the last one so they still leave in full segments.
+        """
+        buffers = [b for b in buffers if len(b)]
+        if hasattr(self.conn, "sendmsg"):
+            self._sendmsg(buffers)
+            return
+        if not MSG_MORE and len(buffers) > 1 and sum([len(b) for b in buffers]) <= HttpOutputStream.JOIN_LIMIT:
+            # A small copy is cheaper than a system call per buffer
+            buffers = ["".join([b if isinstance(b, str) else memoryview(b).tobytes() for b in buffers])]
+        last = len(buffers) - 1
+        for i in range(0, len(buffers)):
+            self.write(buffers[i], MSG_MORE if i != last else 0)
+
+    def _sendmsg(self, buffers):
+        views = [memoryview(b) for b in buffers]
+        if self.client is not None:
+            self.pace(sum([len(v) for v in views]))
+        while len(views):
+            count = self.conn.sendmsg(views[:HttpOutputStream.IOV_MAX])
             if count <= 0:
                 raise IOException("Connection closed before write complete.")
-            written += count
+            self.sent += count
+            # Skip what has been written, a partially written buffer is advanced by slicing its view
+            while count and count >= len(views[0]):
+                count -= len(views[0])
+                views.pop(0)
+            if count:
+                views[0] = views[0][count:]
 
     def close(self):
         try:
@@ -452,97 +1050,2889 @@ class HttpOutputStream:
             pass
 
 
+class TeeOutputStream(HttpOutputStream):
+    """ An output stream that writes through to another one and keeps a copy of what is
+    written. The copy is kept in memory up to limit bytes, beyond that it's handed over to
+    the sink returned by spill() if there is one, otherwise copying stops and overflow is
+    set. A sink has write(data) returning False once it can't take more, and abort().
+    """
+    def __init__(self, out, limit, spill=None):
+        HttpOutputStream.__init__(self, out.conn)
+        self.out = out
+        self.limit = limit
+        self.spill = spill
+        self.sink = None
+        self.parts = []
+        self.size = 0
+        self.overflow = False
+
+    def write(self, data, flags=0):
+        self.out.write(data, flags)
+        if self.overflow:
+            return
+        if self.sink is not None:
+            if not self.sink.write(data):
+                self.abort()
+            return
+        self.size += len(data)
+        if self.size <= self.limit:
+            if not isinstance(data, str):
+                data = memoryview(data).tobytes()
+            self.parts.append(data)
+            return
+        parts = self.parts + [data]
+        self.parts = []
+        self.sink = self.spill() if self.spill is not None else None
+        if self.sink is None:
+            self.overflow = True
+            return
+        for d in parts:
+            if not self.sink.write(d):
+                self.abort()
+                return
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+    def abort(self):
+        """ Stop copying and drop the copy. """
+        self.overflow = True
+        self.parts = []
+        if self.sink is not None:
+            self.sink.abort()
+            self.sink = None
+
+
+def _load_splice():
+    """ Get os.splice (Python 3.10+), or a binding of splice(2) from libc on Linux.
+    :return: A function of signature splice(src, dst, count, flags), or None if not supported.
+    """
+    if hasattr(os, "splice"):
+        return lambda src, dst, count, flags: os.splice(src, dst, count, flags=flags)
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        func = libc.splice
+    except (ImportError, OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+
+    def splice(src, dst, count, flags):
+        n = func(src, None, dst, None, count, flags)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return n
+    return splice
+
+
+splice = _load_splice()
+
+
+def _load_sendfile():
+    """ Get os.sendfile (Python 3.3+), or a binding of sendfile(2) from libc on Linux.
+    :return: A function of signature sendfile(out_fd, in_fd, offset, count), or None if not supported.
+    """
+    if hasattr(os, "sendfile"):
+        return os.sendfile
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        func = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        off = ctypes.c_int64(offset)
+        n = func(out_fd, in_fd, ctypes.byref(off), count)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return n
+    return sendfile
+
+
+sendfile = _load_sendfile()
+
+
+def _load_thread_time():
+    """ Get a function returning the CPU seconds used by the calling thread, on Linux,
+    otherwise the wall clock time. """
+    try:
+        import resource
+    except ImportError:
+        return time.time
+    try:
+        resource.getrusage(1)   # RUSAGE_THREAD
+    except (ValueError, resource.error):
+        return time.time
+    return lambda: sum(resource.getrusage(1)[:2])
+
+
+thread_time = _load_thread_time()
+SPLICE_F_MOVE = 1
+F_SETPIPE_SZ = 1031
+
+
+def open_splice_pipe():
+    """ Create a pipe to splice through.
+    :return: A (read end, write end) tuple, or None if it fails
+    """
+    try:
+        pipe = os.pipe()
+    except OSError:
+        return None
+    try:
+        # A larger pipe moves more per splice call, the default is 64KB
+        import fcntl
+        fcntl.fcntl(pipe[1], F_SETPIPE_SZ, SocketTunnel.PIPE_SIZE)
+    except IOError:
+        pass
+    return pipe
+
+
+class GzipOutputStream(HttpOutputStream):
+    """ An output stream that compresses what is written with gzip and writes it through to
+    another one in chunked coding, see RFC7230 Section 4.1. What is written may be in chunked
+    coding itself, as received from an origin, its framing is dropped. Every write is flushed
+    so that the client gets the data as it comes. finish() ends the body.
+    The time spent compressing is charged to compressor, see Compressor.
+    """
+    def __init__(self, out, compressor, level, ctype, chunked=False):
+        HttpOutputStream.__init__(self, out.conn)
+        self.out = out
+        self.compressor = compressor
+        self.ctype = ctype
+        self.z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.chunked = chunked
+        self.line = ""          # chunk size line received so far
+        self.left = 0           # bytes of chunk data to come
+        self.skip = 0           # bytes of the CRLF after chunk data to come
+        self.ended = False      # the last chunk has come, the rest is the trailer part
+        self.raw = 0            # bytes compressed
+        self.packed = 0         # bytes of compressed data
+        self.cpu = 0.0          # CPU seconds spent compressing
+
+    def write(self, data, flags=0):
+        parts = self._unchunk(data) if self.chunked else [data]
+        self._compress(parts, zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """ Write the end of the compressed data and the last chunk. """
+        self._compress([], zlib.Z_FINISH)
+        self.out.write("0\r\n\r\n")
+        self.compressor.finished(self)
+
+    def _compress(self, parts, mode):
+        start = thread_time()
+        out = []
+        for d in parts:
+            if not isinstance(d, str):
+                d = memoryview(d).tobytes()
+            self.raw += len(d)
+            out.append(self.z.compress(d))
+        out.append(self.z.flush(mode))
+        data = "".join(out)
+        spent = thread_time() - start
+        self.cpu += spent
+        self.compressor.spent(spent)
+        if not len(data):
+            return
+        self.packed += len(data)
+        self.out.writev(["%x\r\n" % len(data), data, "\r\n"])
+
+    def _unchunk(self, data):
+        """ Strip the chunked coding from a piece of a body.
+        :return: A list of the chunk data in it
+        """
+        view = memoryview(data)
+        parts = []
+        pos, end = 0, len(view)
+        while pos < end and not self.ended:
+            if self.left:
+                n = min(self.left, end - pos)
+                parts.append(view[pos:pos + n])
+                pos += n
+                self.left -= n
+                if not self.left:
+                    self.skip = 2
+            elif self.skip:
+                n = min(self.skip, end - pos)
+                pos += n
+                self.skip -= n
+            else:
+                nl = pos
+                while nl < end and view[nl] != "\n":
+                    nl += 1
+                self.line += view[pos:nl].tobytes()
+                pos = nl
+                if nl == end:
+                    break
+                pos += 1
+                size = self.line.split(";", 1)[0].strip(" \t\r")
+                self.line = ""
+                try:
+                    size = int(size, 16)
+                except ValueError:
+                    raise IOException("Bad chunk size: " + size)
+                if size:
+                    self.left = size
+                else:
+                    self.ended = True
+        return parts
+
+
 class SocketTunnel:
-    def __init__(self, peers):
+    # Move tunnelled data from socket to socket through a pipe with splice(2), the data
+    # never gets copied into user space. Falls back to copying with a reusable buffer.
+    USE_SPLICE = True
+    CHUNK = 64 * 1024
+    PIPE_SIZE = 256 * 1024
+    IDLE_TIMEOUT = 300.0        # seconds without traffic before the tunnel is closed, None for no limit
+
+    def __init__(self, peers, client=None):
         """
-        :param peers: a pair of sockets to create the tunnel
+        :param peers: a pair of sockets to create the tunnel, the client side first
+        :param client: address of the client to shape the tunnel for, None if not shaped
         """
         self.peers = peers
+        self.client = client
+        self.held = 0           # time until which the remote side is not read, see Shaper
+        self.pipe = None
+        self.buf = None
 
     def run(self):
-        while True:
-            r, w, x = select.select(self.peers, [], self.peers)
-            if len(r):
-                self._forward(r[0])
-            if len(r) == 2:
-                self._forward(r[1])
-            if len(x):
-                break
+        if SocketTunnel.USE_SPLICE and splice is not None:
+            self.pipe = open_splice_pipe()
+        if self.pipe is None:
+            self.buf = buffer_pool.get(SocketTunnel.CHUNK)
+        try:
+            while True:
+                peers, wait = self.peers, SocketTunnel.IDLE_TIMEOUT
+                held = self.held - time.time()
+                if held > 0:
+                    peers = self.peers[:1]
+                    wait = held if wait is None else min(wait, held)
+                r, w, x = select.select(peers, [], self.peers, wait)
+                if not len(r) and not len(x):
+                    if held > 0:
+                        continue
+                    raise TimeoutException("tunnel", "Socket tunnel idle for %gs." % SocketTunnel.IDLE_TIMEOUT)
+                if len(x):
+                    break
+                if not self._forward(r[0]):
+                    break
+                if len(r) == 2 and not self._forward(r[1]):
+                    break
+        finally:
+            self._close_pipe()
+            if self.buf is not None:
+                buffer_pool.put(self.buf)
+                self.buf = None
         # Close the tunnel by raising an IOException
         raise IOException("Socket tunnel closed.")
 
     def _forward(self, src):
+        """ Forward the data available from src to its peer.
+        :return: False if src has been closed
+        """
         dst = self.peers[0]
         if src == self.peers[0]:
             dst = self.peers[1]
-        d = src.recv(16 * 1024)
-        dst.sendall(d)
+        if self.pipe is not None:
+            try:
+                return self._splice(src, dst)
+            except OSError, e:
+                if e.errno != errno.EINVAL or self.buf is not None:
+                    raise IOException("Tunnel splice failed: " + os.strerror(e.errno))
+                # Sockets that can't be spliced, e.g. an SSL wrapped one
+                self._close_pipe()
+                self.buf = buffer_pool.get(SocketTunnel.CHUNK)
+        n = src.recv_into(self.buf)
+        if n == 0:
+            return False
+        dst.sendall(memoryview(self.buf)[:n])
+        self._shape(dst, n)
+        return True
 
+    def _splice(self, src, dst):
+        # The socket timeouts make both fds non-blocking, either splice may see EAGAIN
+        try:
+            n = splice(src.fileno(), self.pipe[1], SocketTunnel.PIPE_SIZE, SPLICE_F_MOVE)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            raise
+        if n == 0:
+            return False
+        sent = n
+        while n:
+            try:
+                # No SPLICE_F_MORE, it corks dst and holds back the last segment of every
+                # exchange for 200ms
+                n -= splice(self.pipe[0], dst.fileno(), n, SPLICE_F_MOVE)
+            except OSError, e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+                # dst is full, wait for it as long as a blocking send would
+                if not wait_writable(dst, dst.gettimeout()):
+                    raise TimeoutException("body", "Connection stalled for %gs." % dst.gettimeout())
+        self._shape(dst, sent)
+        return True
 
-class HttpProxyHandler:
-    MAX_HEADER = 128 * 1024
-    KEEP_ALIVE_DEFAULT = True
+    def _shape(self, dst, n):
+        if self.client is None or dst is not self.peers[0]:
+            return
+        wait = shaper.take(self.client, n)
+        if wait:
+            self.held = time.time() + wait
 
-    def __init__(self, s):
-        self.client_conn = s
-        self.client_input = HttpInputStream(s)
-        self.client_output = HttpOutputStream(s)
-        self.remote_addr = None
-        self.remote_conn = None
-        self.remote_input = None
-        self.remote_output = None
+    def _close_pipe(self):
+        if self.pipe is None:
+            return
+        for fd in self.pipe:
+            os.close(fd)
+        self.pipe = None
 
-    def run(self):
-        keep_alive = True
-        try:
-            while keep_alive:
-                r = self.client_input.read_request()
 
-                keep_alive = HttpProxyHandler.KEEP_ALIVE_DEFAULT
-                connspec = r.get("Proxy-Connection")
-                if connspec is not None:
-                    keep_alive = connspec.lower() == "keep-alive"
+SPLICE_F_NONBLOCK = 2
 
-                self.handle_request(r)
-        except IOException, e:
-            log(e.reason, level=5)
-        except Exception:
-            # TODO handle exceptions here
-            pass
-        finally:
-            self.final_clean()
 
-    def close_remote(self):
-        if self.remote_conn is None:
-            return
-        if self.remote_input is not None:
-            self.remote_input.close()
-            self.remote_input = None
-        if self.remote_output is not None:
-            self.remote_output.close()
-            self.remote_output = None
-        close_nothrow(self.remote_conn)
-        self.remote_conn = None
-        self.remote_addr = None
+class _TunnelFlow:
+    """ One direction of a tunnel. Data read from src waits in a pipe (splice mode), or in
+    a copy of the part dst didn't accept at once (copy mode), src is not read again until
+    dst has accepted all of it.
+    """
+    def __init__(self, src, dst, use_splice):
+        self.src = src
+        self.dst = dst
+        self.pending = 0        # bytes read from src but not sent to dst yet
+        self.eof = False        # src has been closed
+        self.shut = False       # dst has been shut down for writing
+        self.held = False       # src is not read until a timer of the loop runs out, see Shaper
+        self.pipe = None
+        self.data = None        # memoryview of the pending data in copy mode
+        self.slab = None        # buffer of data once it's kept, borrowed from buffer_pool
+        if use_splice:
+            self.pipe = open_splice_pipe()
 
-    def final_clean(self):
-        self.client_input.close()
-        self.client_output.close()
-        close_nothrow(self.client_conn)
-        self.close_remote()
+    def wants_input(self):
+        return not self.eof and self.pending == 0 and not self.held
 
-    def handle_request(self, request):
-        method = request.method()
-        if method == "CONNECT":
-            return self.handle_CONNECT(request)
-        elif method not in ["GET", "HEAD", "POST", "PUT", "DELETE", "TRACE", "OPTIONS"]:
-            raise IOException("Unknown method: " + method)
+    def wants_output(self):
+        return self.pending != 0
 
-        original_url = request.target()
+    def pull(self, scratch):
+        """ Read from src and forward as much as possible to dst.
+        :param scratch: A buffer to receive into in copy mode, shared by all flows of a thread
+        :return: Number of bytes read
+        """
+        try:
+            if self.pipe is not None:
+                n = splice(self.src.fileno(), self.pipe[1], SocketTunnel.PIPE_SIZE,
+                           SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+            else:
+                n = self.src.recv_into(scratch)
+                self.data = memoryview(scratch)[:n]
+        except (OSError, socket.error), e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise
+        if n == 0:
+            self.eof = True
+        self.pending = n
+        self.push()
+        if self.pending and self.pipe is None:
+            # Keep what dst didn't take, scratch is going to be reused
+            self.slab = buffer_pool.get(self.pending)
+            self.slab[0:self.pending] = self.data
+            self.data = memoryview(self.slab)[:self.pending]
+        return n
+
+    def push(self):
+        """ Send pending data to dst, shut dst down once src is closed and all sent. """
+        while self.pending:
+            try:
+                if self.pipe is not None:
+                    n = splice(self.pipe[0], self.dst.fileno(), self.pending,
+                               SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+                else:
+                    n = self.dst.send(self.data)
+                    self.data = self.data[n:]
+            except (OSError, socket.error), e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            self.pending -= n
+        self._drop_data()
+        if self.eof and not self.shut:
+            self.shut = True
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+
+    def _drop_data(self):
+        self.data = None
+        if self.slab is not None:
+            buffer_pool.put(self.slab)
+            self.slab = None
+
+    def close(self):
+        self._drop_data()
+        if self.pipe is not None:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+
+
+class _Tunnel:
+    def __init__(self, peers, use_splice, client=None):
+        self.peers = peers
+        self.client = client    # address of the client to shape flows[1] for, None if not shaped
+        self.flows = (_TunnelFlow(peers[0], peers[1], use_splice), _TunnelFlow(peers[1], peers[0], use_splice))
+        self.masks = [0, 0]
+        self.touched = time.time()
+        self.relayed = 0
+
+    def done(self):
+        return self.flows[0].shut and self.flows[1].shut
+
+    def mask(self, i):
+        """ Get the epoll events wanted on peers[i], which is the source of flows[i] and
+        the destination of the other flow. """
+        m = 0
+        if self.flows[i].wants_input():
+            m |= select.EPOLLIN
+        if self.flows[1 - i].wants_output():
+            m |= select.EPOLLOUT
+        return m
+
+
+class TunnelReactor:
+    """ Services established CONNECT tunnels of all handlers on a few epoll threads, so
+    that a tunnel doesn't hold a handler thread for its lifetime.
+    Each direction of a tunnel buffers at most one read, the source is not read again
+    until the destination has accepted it. When one side closes, the other side is shut
+    down for writing once the pending data is sent, the tunnel is closed when both
+    directions are done. Tunnels without traffic for idle_timeout seconds are reaped, None
+    for no limit.
+    """
+    def __init__(self, threads=1, idle_timeout=300.0):
+        self.idle_timeout = idle_timeout
+        self.loops = [_TunnelLoop(self) for _ in range(0, threads)]
+        self.next_loop = 0
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.closed = 0
+        self.reaped = 0
+        self.relayed = 0
+
+    def start(self):
+        for loop in self.loops:
+            t = threading.Thread(target=loop.run)
+            t.daemon = True
+            t.start()
+
+    def add(self, peers, client=None):
+        """ Take over a pair of connected sockets, the caller must not use them afterwards.
+        :param peers: The client side and the remote side
+        :param client: Address of the client to shape the tunnel for, None if not shaped
+        """
+        for conn in peers:
+            conn.setblocking(0)
+        with self.lock:
+            loop = self.loops[self.next_loop]
+            self.next_loop = (self.next_loop + 1) % len(self.loops)
+            self.opened += 1
+        loop.add(peers, client)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "active": self.opened - self.closed,
+                "opened": self.opened,
+                "closed": self.closed,
+                "reaped": self.reaped,
+                "bytes": self.relayed + sum([loop.relayed() for loop in self.loops]),
+            }
+
+    def _closed(self, tunnel, reaped):
+        with self.lock:
+            self.closed += 1
+            self.relayed += tunnel.relayed
+            if reaped:
+                self.reaped += 1
+        if reaped:
+            timeouts.expired("tunnel")
+
+
+class _TunnelLoop:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.epoll = select.epoll()
+        self.wakeup = os.pipe()
+        self.incoming = collections.deque()             # (socket pair, client) handed over by handlers
+        self.timers = []                                # heap of (time, sequence, tunnel) of held flows
+        self.sequence = 0
+        self.fds = {}                                   # fd -> (tunnel, peer index)
+        self.tunnels = collections.OrderedDict()        # tunnel -> None, least recently active first
+        self.scratch = bytearray(SocketTunnel.CHUNK)    # receive buffer of copy mode
+
+    def add(self, peers, client):
+        self.incoming.append((peers, client))
+        try:
+            os.write(self.wakeup[1], "x")
+        except OSError:
+            pass
+
+    def relayed(self):
+        return sum([t.relayed for t in self.tunnels.keys()])
+
+    def run(self):
+        self.epoll.register(self.wakeup[0], select.EPOLLIN)
+        while True:
+            timeout = 1.0
+            if len(self.timers):
+                timeout = max(0.0, min(timeout, self.timers[0][0] - time.time()))
+            try:
+                events = self.epoll.poll(timeout)
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            now = time.time()
+            for fd, ev in events:
+                if fd == self.wakeup[0]:
+                    self._accept(now)
+                elif fd in self.fds:
+                    tunnel, i = self.fds[fd]
+                    self._service(tunnel, i, ev, now)
+            self._release(time.time())
+            self._reap(now)
+
+    def _accept(self, now):
+        try:
+            os.read(self.wakeup[0], 4096)
+        except OSError:
+            pass
+        while len(self.incoming):
+            peers, client = self.incoming.popleft()
+            tunnel = _Tunnel(peers, SocketTunnel.USE_SPLICE and splice is not None, client)
+            tunnel.touched = now
+            self.tunnels[tunnel] = None
+            for i in range(0, 2):
+                fd = tunnel.peers[i].fileno()
+                self.fds[fd] = (tunnel, i)
+                tunnel.masks[i] = tunnel.mask(i)
+                self.epoll.register(fd, tunnel.masks[i])
+
+    def _service(self, tunnel, i, ev, now):
+        try:
+            if ev & select.EPOLLERR:
+                raise IOException("Tunnel peer error.")
+            inbound = tunnel.flows[i]
+            if ev & (select.EPOLLIN | select.EPOLLHUP):
+                if inbound.eof:
+                    # Hung up after its half was closed, nothing more can be delivered
+                    raise IOException("Tunnel peer hung up.")
+                if inbound.wants_input():
+                    n = inbound.pull(self.scratch)
+                    tunnel.relayed += n
+                    if n and i == 1 and tunnel.client is not None:
+                        self._shape(tunnel, n, now)
+            if ev & select.EPOLLOUT:
+                tunnel.flows[1 - i].push()
+        except (IOException, OSError, socket.error):
+            self._close(tunnel)
+            return
+        if tunnel.done():
+            self._close(tunnel)
+            return
+        self._update(tunnel)
+        if now - tunnel.touched >= 1.0:
+            # Keep tunnels ordered by activity, at most one move per second
+            tunnel.touched = now
+            del self.tunnels[tunnel]
+            self.tunnels[tunnel] = None
+
+    def _update(self, tunnel):
+        for j in range(0, 2):
+            m = tunnel.mask(j)
+            if m != tunnel.masks[j]:
+                tunnel.masks[j] = m
+                self.epoll.modify(tunnel.peers[j].fileno(), m)
+
+    def _shape(self, tunnel, n, now):
+        """ Charge n bytes sent to the client, stop reading the remote side for a while if
+        the client has run too far into debt. """
+        wait = shaper.take(tunnel.client, n)
+        if wait:
+            tunnel.flows[1].held = True
+            self.sequence += 1
+            heapq.heappush(self.timers, (now + wait, self.sequence, tunnel))
+
+    def _release(self, now):
+        while len(self.timers) and self.timers[0][0] <= now:
+            tunnel = heapq.heappop(self.timers)[2]
+            if tunnel not in self.tunnels:
+                continue
+            tunnel.flows[1].held = False
+            self._update(tunnel)
+
+    def _reap(self, now):
+        if self.reactor.idle_timeout is None:
+            return
+        deadline = now - self.reactor.idle_timeout
+        while len(self.tunnels):
+            tunnel = next(self.tunnels.iterkeys())
+            if tunnel.touched > deadline:
+                break
+            self._close(tunnel, reaped=True)
+
+    def _close(self, tunnel, reaped=False):
+        if tunnel not in self.tunnels:
+            return
+        del self.tunnels[tunnel]
+        for conn in tunnel.peers:
+            fd = conn.fileno()
+            self.fds.pop(fd, None)
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, ValueError):
+                pass
+            close_nothrow(conn)
+        for flow in tunnel.flows:
+            flow.close()
+        self.reactor._closed(tunnel, reaped)
+
+
+# Reactor serving CONNECT tunnels, None to relay each tunnel in its own handler thread
+tunnel_reactor = None
+
+
+def is_alive(conn):
+    """ Test whether an idle connection is still usable, i.e. the peer hasn't closed it
+    and there is no unexpected data pending on it. """
+    timeout = conn.gettimeout()
+    try:
+        conn.settimeout(0)
+        try:
+            conn.recv(1, socket.MSG_PEEK)
+        finally:
+            conn.settimeout(timeout)
+    except socket.error, e:
+        return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+    # Either closed by peer or there is garbage data
+    return False
+
+
+class UpstreamPool:
+    """ A process wide pool of idle keep-alive connections to upstream servers, keyed by
+    (host, port). Idle connections older than idle_timeout are evicted, and a connection
+    is checked by is_alive() before it is reused.
+    """
+    def __init__(self, max_per_host=8, max_total=512, idle_timeout=30.0):
+        self.max_per_host = max_per_host
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.hosts = {}                                 # (host, port) -> idle connections, oldest first
+        self.lru = collections.OrderedDict()            # connection -> (addr, release time), oldest first
+        self.next_expire = 0
+        self.hits = 0
+        self.misses = 0
+        self.released = 0
+        self.evicted = 0
+        self.stale = 0
+
+    def __len__(self):
+        return len(self.lru)
+
+    def acquire(self, addr):
+        """ Get an idle connection to addr.
+        :return: A connected socket, or None if there is no usable idle connection.
+        """
+        while True:
+            with self.lock:
+                self._expire(time.time())
+                conns = self.hosts.get(addr)
+                if not conns:
+                    self.misses += 1
+                    return None
+                # The most recently used one is the most likely to be alive
+                conn = conns.pop()
+                self._forget(addr, conn)
+            if is_alive(conn):
+                with self.lock:
+                    self.hits += 1
+                return conn
+            with self.lock:
+                self.stale += 1
+            close_nothrow(conn)
+
+    def release(self, addr, conn):
+        """ Put an idle connection to the pool, the pool may close it instead. """
+        if self.max_per_host <= 0 or self.max_total <= 0:
+            close_nothrow(conn)
+            return
+        victims = []
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            conns = self.hosts.get(addr, [])
+            if len(conns) >= self.max_per_host:
+                victims.append(conns.pop(0))
+                self._forget(addr, victims[-1])
+            while len(self.lru) >= self.max_total:
+                victim, (vaddr, since) = self.lru.popitem(last=False)
+                self.hosts[vaddr].remove(victim)
+                self._forget(vaddr, None)
+                victims.append(victim)
+            # An eviction may have dropped the list of addr along with its last connection
+            self.hosts.setdefault(addr, []).append(conn)
+            self.lru[conn] = (addr, now)
+            self.released += 1
+            self.evicted += len(victims)
+        for victim in victims:
+            close_nothrow(victim)
+
+    def clear(self):
+        with self.lock:
+            conns = self.lru.keys()
+            self.hosts = {}
+            self.lru.clear()
+        for conn in conns:
+            close_nothrow(conn)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "idle": len(self.lru),
+                "hosts": len(self.hosts),
+                "hits": self.hits,
+                "misses": self.misses,
+                "released": self.released,
+                "evicted": self.evicted,
+                "stale": self.stale,
+            }
+
+    def _forget(self, addr, conn):
+        # Lock must be held
+        if conn is not None:
+            del self.lru[conn]
+        if addr in self.hosts and not self.hosts[addr]:
+            del self.hosts[addr]
+
+    def _expire(self, now):
+        # Lock must be held. Scans at most once per second, only the expired entries are visited.
+        if now < self.next_expire:
+            return
+        self.next_expire = now + 1.0
+        while len(self.lru):
+            conn, (addr, since) = next(self.lru.iteritems())
+            if now - since < self.idle_timeout:
+                break
+            del self.lru[conn]
+            self.hosts[addr].remove(conn)
+            self._forget(addr, None)
+            self.evicted += 1
+            close_nothrow(conn)
+
+
+# Idle upstream connections shared by all handlers
+upstream_pool = UpstreamPool()
+
+
+class ParentProxy:
+    def __init__(self, host, port):
+        self.addr = (host, port)
+        self.outstanding = 0        # requests sent through it and not done yet
+        self.failures = 0           # consecutive failures
+        self.ejected_until = 0
+        self.requests = 0
+
+    def __str__(self):
+        return "%s:%d" % self.addr
+
+
+def parse_parent(spec):
+    """ Parse a parent proxy address "host:port". """
+    host, sep, port = spec.rpartition(":")
+    if not sep or not host or not port.isdigit():
+        raise argparse.ArgumentTypeError("Bad parent proxy address: " + spec)
+    return ParentProxy(host, int(port))
+
+
+class ParentPool:
+    """ Parent proxies that requests are forwarded to instead of their origin servers.
+    A request goes to the parent with the fewest outstanding requests, parents with the
+    fewest recent failures and then the next ones in turn are preferred among equals.
+    Failures are noticed passively: a parent that can't be connected max_failures times
+    in a row is left out for eject_time seconds. It's then on probation, a single failure
+    ejects it again. When all parents are ejected, the one due back first is used.
+    Connections to parents are kept alive in upstream_pool like the ones to origins.
+    """
+    def __init__(self, parents, max_failures=3, eject_time=30.0):
+        self.parents = parents
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.lock = threading.Lock()
+        self.next = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    def pick(self):
+        """ Choose the parent for a request and count it as outstanding there, see release. """
+        with self.lock:
+            now = time.time()
+            count = len(self.parents)
+            best = None
+            for i in range(0, count):
+                p = self.parents[(self.next + i) % count]
+                if p.ejected_until:
+                    if p.ejected_until > now:
+                        continue
+                    p.ejected_until = 0
+                    p.failures = self.max_failures - 1
+                if best is None or (p.outstanding, p.failures) < (best.outstanding, best.failures):
+                    best = p
+            if best is None:
+                best = min(self.parents, key=lambda p: p.ejected_until)
+            self.next = (self.next + 1) % count
+            best.outstanding += 1
+            best.requests += 1
+            self.requests += 1
+            return best
+
+    def charge(self, parent):
+        """ Count another request as outstanding at parent, one sent over a connection to it
+        without being picked. See release. """
+        with self.lock:
+            parent.outstanding += 1
+            parent.requests += 1
+            self.requests += 1
+
+    def release(self, parent):
+        with self.lock:
+            parent.outstanding -= 1
+
+    def succeeded(self, parent):
+        with self.lock:
+            parent.failures = 0
+
+    def failed(self, parent):
+        with self.lock:
+            self.failures += 1
+            parent.failures += 1
+            if parent.failures < self.max_failures or parent.ejected_until:
+                return
+            parent.ejected_until = time.time() + self.eject_time
+            self.ejections += 1
+        warn("Parent proxy %s failed %d times, ejected for %gs." % (parent, parent.failures, self.eject_time))
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            return {
+                "parents": len(self.parents),
+                "healthy": len([p for p in self.parents if p.ejected_until <= now]),
+                "outstanding": sum([p.outstanding for p in self.parents]),
+                "requests": self.requests,
+                "failures": self.failures,
+                "ejections": self.ejections,
+            }
+
+
+# Parent proxies to forward requests to, None to connect to origin servers directly
+parents = None
+
+
+def _numeric_address(host):
+    """ Get the family of an IP address literal, None if host is a name. """
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return family
+        except (socket.error, ValueError):
+            pass
+    return None
+
+
+def system_resolve(host):
+    """ Resolve a host name with getaddrinfo(3).
+    :return: A list of (family, sockaddr) with port 0
+    """
+    infos = socket.getaddrinfo(host, 0, socket.AF_UNSPEC, socket.SOCK_STREAM)
+    return [(info[0], info[4]) for info in infos]
+
+
+class HostsResolver:
+    """ A resolver answering from a file in the format of /etc/hosts, names missing
+    from the file are passed to fallback, or fail if there is none. """
+    def __init__(self, path, fallback=system_resolve):
+        self.fallback = fallback
+        self.names = {}
+        with open(path) as f:
+            for ln in f:
+                fields = ln.split("#", 1)[0].split()
+                if len(fields) < 2:
+                    continue
+                family = _numeric_address(fields[0])
+                if family is None:
+                    continue
+                sockaddr = (fields[0], 0) if family == socket.AF_INET else (fields[0], 0, 0, 0)
+                for name in fields[1:]:
+                    self.names.setdefault(name.lower(), []).append((family, sockaddr))
+
+    def __call__(self, host):
+        addresses = self.names.get(host.lower())
+        if addresses is not None:
+            return list(addresses)
+        if self.fallback is None:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return self.fallback(host)
+
+
+class _Lookup:
+    def __init__(self):
+        self.done = threading.Event()
+        self.addresses = None
+        self.error = None
+
+
+class DnsCache:
+    """ Caches host name resolutions for ttl seconds, and failures for negative_ttl
+    seconds. getaddrinfo doesn't tell the TTL of the records, the times are fixed.
+    Concurrent resolutions of a name wait for the first one instead of querying again.
+    """
+    def __init__(self, ttl=60.0, negative_ttl=5.0, max_entries=4096, resolve=system_resolve):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.resolve = resolve
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()    # name -> (expiry, addresses or gaierror), oldest first
+        self.lookups = {}                           # name -> _Lookup in progress
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.joined = 0
+        self.failures = 0
+
+    def lookup(self, host):
+        """ Resolve a host name.
+        :return: A list of (family, sockaddr) with port 0
+        :raise socket.gaierror: if the name doesn't resolve
+        """
+        name = host.lower()
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                if entry[0] > time.time():
+                    if isinstance(entry[1], Exception):
+                        self.negative_hits += 1
+                        raise entry[1]
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[name]
+            lookup = self.lookups.get(name)
+            owner = lookup is None
+            if owner:
+                lookup = self.lookups[name] = _Lookup()
+                self.misses += 1
+            else:
+                self.joined += 1
+        if not owner:
+            lookup.done.wait()
+        else:
+            self._resolve(name, lookup)
+        if lookup.error is not None:
+            raise lookup.error
+        return lookup.addresses
+
+    def _resolve(self, name, lookup):
+        ttl = self.ttl
+        try:
+            lookup.addresses = self.resolve(name)
+        except socket.gaierror, e:
+            lookup.error = e
+            ttl = self.negative_ttl
+        except Exception, e:
+            # Not a resolver answer, the next lookup tries again
+            lookup.error = socket.gaierror(socket.EAI_FAIL, str(e))
+            ttl = 0
+        with self.lock:
+            del self.lookups[name]
+            if lookup.error is not None:
+                self.failures += 1
+            if ttl > 0:
+                result = lookup.addresses if lookup.error is None else lookup.error
+                self.entries[name] = (time.time() + ttl, result)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        lookup.done.set()
+
+    def connect(self, host, port, timeout=None):
+        """ Connect to host:port like socket.create_connection, trying the addresses in turn. """
+        family = _numeric_address(host)
+        if family is not None:
+            addresses = [(family, (host, 0) if family == socket.AF_INET else (host, 0, 0, 0))]
+        else:
+            start = time.time()
+            addresses = self.lookup(host)
+            metrics.record("dns", time.time() - start)
+        start = time.time()
+        err = None
+        for family, sockaddr in addresses:
+            conn = None
+            try:
+                conn = socket.socket(family, socket.SOCK_STREAM)
+                if timeout is not None:
+                    conn.settimeout(timeout)
+                conn.connect(sockaddr[:1] + (port,) + sockaddr[2:])
+                metrics.record("connect", time.time() - start)
+                return conn
+            except socket.error, e:
+                if isinstance(e, socket.timeout):
+                    timeouts.expired("connect")
+                err = e
+                close_nothrow(conn)
+        raise err or socket.error("No address for " + host)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "joined": self.joined,
+                "failures": self.failures,
+            }
+
+
+# Host name resolutions shared by all handlers
+resolver = DnsCache()
+
+
+def parse_cache_control(value):
+    """ Parse a Cache-Control header value.
+    :return: A dict of lower cased directive names to their values, None for directives without value
+    """
+    directives = {}
+    if not value:
+        return directives
+    for d in value.split(","):
+        p = d.find("=")
+        if p == -1:
+            directives[d.strip(" \t").lower()] = None
+        else:
+            directives[d[:p].strip(" \t").lower()] = d[p + 1:].strip(" \t\"")
+    return directives
+
+
+def parse_http_date(value):
+    """ Parse an HTTP-date into a timestamp, None if it's invalid. """
+    if not value:
+        return None
+    t = email.utils.parsedate_tz(value)
+    if t is None:
+        return None
+    try:
+        return email.utils.mktime_tz(t)
+    except (OverflowError, ValueError):
+        return None
+
+
+def cache_key(url, request, vary):
+    """ Get the key of a stored response, its URL and the request values of its Vary headers. """
+    return url, tuple([request.get(name) for name in vary])
+
+
+def vary_names(response):
+    """ Get the sorted lower cased names of the Vary headers of a response. """
+    names = ",".join(response.headers.getall("Vary")).split(",")
+    return tuple(sorted([n.strip(" \t").lower() for n in names if n.strip(" \t")]))
+
+
+def _seconds(directives, name, default_value=None):
+    try:
+        return int(directives[name])
+    except (KeyError, TypeError, ValueError):
+        return default_value
+
+
+class CacheEntry:
+    """ A stored response. Entries are never modified once in the cache, a revalidated
+    response replaces its entry. """
+    def __init__(self, key, vary, response, body, now):
+        self.key = key                      # (URL, request values of the Vary headers)
+        self.vary = vary                    # lower cased names of the Vary headers
+        self.start_line = response.start_line
+        self.headers = HttpHeaders()
+        for k, v in response.headers:
+            self.headers.append(k, v)
+        self.body = body                    # body in the framing it was received
+        self.stored = now
+        age = response.get("Age", "").strip(" \t")
+        self.age = int(age) if age.isdigit() else 0
+        self.etag = response.get("ETag")
+        self.last_modified = response.get("Last-Modified")
+        self.size = len(self.start_line) + len(str(self.headers)) + len(body)
+
+        # Freshness lifetime, see RFC7234 Section 4.2.1
+        cc = parse_cache_control(response.get("Cache-Control"))
+        self.lifetime = _seconds(cc, "s-maxage", _seconds(cc, "max-age"))
+        if self.lifetime is None:
+            expires = parse_http_date(response.get("Expires"))
+            date = parse_http_date(response.get("Date")) or now
+            self.lifetime = 0 if expires is None else int(expires - date)
+        if "no-cache" in cc:
+            self.lifetime = 0
+
+    def current_age(self, now):
+        return self.age + max(0, now - self.stored)
+
+    def fresh(self, now, request_cc):
+        age = self.current_age(now)
+        if age + _seconds(request_cc, "min-fresh", 0) >= self.lifetime:
+            return False
+        return age <= _seconds(request_cc, "max-age", age)
+
+    def response(self, now):
+        r = HttpResponse()
+        r.start_line = self.start_line
+        for k, v in self.headers:
+            r.add(k, v)
+        r.headers.set("Age", str(int(self.current_age(now))))
+        r.body = self.body
+        return r
+
+
+def shareable(request, response):
+    """ Test whether a response to request may be given to other clients, see RFC7234 Section 3. """
+    if response.code() not in ResponseCache.CACHEABLE_STATUS:
+        return False
+    if request.has("Authorization") or response.has("Set-Cookie"):
+        return False
+    cc = parse_cache_control(response.get("Cache-Control"))
+    if "no-store" in cc or "private" in cc:
+        return False
+    return response.get("Vary", "").strip(" \t") != "*"
+
+
+def not_modified_response(entry, response):
+    """ Merge a 304 (Not Modified) response into a stored response, see RFC7234 Section 4.3.4.
+    :return: An HttpResponse with the updated header of entry
+    """
+    r = HttpResponse()
+    r.start_line = entry.start_line
+    for k, v in entry.headers:
+        r.add(k, v)
+    for k, v in response.headers:
+        if k.lower() not in ("content-length", "transfer-encoding", "connection"):
+            r.headers.set(k, v)
+    return r
+
+
+class ResponseCache:
+    """ An in-memory cache of GET responses, shared by all handlers.
+    Responses are stored according to their Cache-Control, Expires and Vary headers, and
+    evicted least recently used first once the total size exceeds the memory budget.
+    Stale entries with a validator are revalidated with a conditional request.
+    Responses larger than max_object go to the DiskCache tier if there is one.
+    """
+    CACHEABLE_STATUS = (200, 203, 300, 301, 404, 410)
+
+    def __init__(self, budget=64 * 1024 * 1024, max_object=None, disk=None):
+        self.budget = budget
+        self.max_object = max_object or max(budget / 16, 1)
+        self.disk = disk
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()    # key -> CacheEntry, least recently used first
+        self.urls = {}                              # URL -> [Vary header names of its last stored response, entries]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stores = 0
+        self.evictions = 0
+        self.hit_bytes = 0
+
+    def lookup(self, url, request):
+        """ Find the stored response matching the request, fresh or not. """
+        with self.lock:
+            known = self.urls.get(url)
+            entry = None
+            if known is not None:
+                entry = self.entries.pop(cache_key(url, request, known[0]), None)
+            if entry is not None:
+                # Most recently used goes to the end
+                self.entries[entry.key] = entry
+                return entry
+        if self.disk is not None:
+            entry = self.disk.lookup(url, request)
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+        return entry
+
+    def usable(self, entry, request, now):
+        """ Test whether an entry may be served without contacting the origin. """
+        cc = parse_cache_control(request.get("Cache-Control"))
+        if "no-cache" in cc or (not cc and request.get("Pragma", "").lower() == "no-cache"):
+            return False
+        return entry.fresh(now, cc)
+
+    def storable(self, request, response):
+        if not shareable(request, response) or body_until_close(response):
+            return False
+        if "no-store" in parse_cache_control(request.get("Cache-Control")):
+            return False
+        cc = parse_cache_control(response.get("Cache-Control"))
+        limit = self.max_object if self.disk is None else max(self.max_object, self.disk.max_object)
+        if response.get_int("Content-Length", 0) > limit:
+            return False
+        # Either it can be fresh, or it can be revalidated
+        return "max-age" in cc or "s-maxage" in cc or response.has("Expires") or \
+            response.has("ETag") or response.has("Last-Modified")
+
+    def tee(self, out, response):
+        """ Get an output stream that relays a storable response body to out and captures it. """
+        spill = None
+        limit = self.max_object
+        if self.disk is not None:
+            spill = self.disk.fill
+            if response.get_int("Content-Length", 0) > limit:
+                # Known to be large, straight to disk
+                limit = 0
+        return TeeOutputStream(out, limit, spill)
+
+    def finish(self, tee, url, request, response, now):
+        """ Store a response captured by tee(), the whole body must have been relayed. """
+        if tee.overflow:
+            return
+        if tee.sink is not None:
+            tee.sink.commit(url, request, response, now)
+            tee.sink = None
+        elif response.body_pending:
+            self.store(url, request, response, tee.getvalue(), now)
+        else:
+            self.store(url, request, response, response.body, now)
+
+    def store(self, url, request, response, body, now):
+        vary = vary_names(response)
+        entry = CacheEntry(cache_key(url, request, vary), vary, response, body, now)
+        self._insert(url, entry)
+        return entry
+
+    def refresh(self, entry, response, now):
+        """ Update a stored response with a 304 (Not Modified) response, see RFC7234 Section 4.3.4. """
+        with self.lock:
+            self.revalidated += 1
+        if isinstance(entry, DiskEntry):
+            return self.disk.refresh(entry, response, now)
+        fresh = CacheEntry(entry.key, entry.vary, not_modified_response(entry, response), entry.body, now)
+        self._insert(entry.key[0], fresh)
+        return fresh
+
+    def served(self, entry):
+        if isinstance(entry, DiskEntry):
+            self.disk.served(entry)
+        with self.lock:
+            self.hits += 1
+            self.hit_bytes += len(entry.body)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "budget": self.budget,
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidated": self.revalidated,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_bytes": self.hit_bytes,
+            }
+
+    def _insert(self, url, entry):
+        if entry.size > self.max_object:
+            return
+        with self.lock:
+            old = self.entries.pop(entry.key, None)
+            if old is not None:
+                self._forget(old)
+            self.entries[entry.key] = entry
+            known = self.urls.setdefault(url, [entry.vary, 0])
+            known[0] = entry.vary
+            known[1] += 1
+            self.size += entry.size
+            self.stores += 1
+            while self.size > self.budget:
+                self._forget(self.entries.popitem(last=False)[1])
+                self.evictions += 1
+
+    def _forget(self, entry):
+        # Lock must be held, entry has been removed from entries
+        self.size -= entry.size
+        known = self.urls[entry.key[0]]
+        known[1] -= 1
+        if not known[1]:
+            del self.urls[entry.key[0]]
+
+
+class DiskEntry(CacheEntry):
+    """ A stored response whose body is in a segment file of DiskCache. """
+    def __init__(self, key, vary, response, segment, offset, length, now):
+        CacheEntry.__init__(self, key, vary, response, "", now)
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+        self.size += length
+
+
+class _Segment:
+    def __init__(self, id, path):
+        self.id = id
+        self.path = path
+        self.fd = None          # write end, while the segment can take more objects
+        self.size = 0
+        self.keys = set()       # keys of the entries stored in this segment
+
+
+class _DiskFill:
+    """ Appends a response body to a segment while it is relayed, see TeeOutputStream. """
+    def __init__(self, cache, segment):
+        self.cache = cache
+        self.segment = segment
+        self.offset = segment.size
+        self.length = 0
+
+    def write(self, data):
+        if self.length + len(data) > self.cache.max_object:
+            return False
+        view = memoryview(data)
+        try:
+            while len(view):
+                n = os.write(self.segment.fd, view)
+                view = view[n:]
+                self.length += n
+        except OSError, e:
+            warn("Disk cache write failed: " + os.strerror(e.errno))
+            return False
+        return True
+
+    def commit(self, url, request, response, now):
+        self.cache._commit(self, url, request, response, now)
+
+    def abort(self):
+        self.cache._release(self)
+
+
+def _text(data):
+    """ Map bytes to text one to one, for JSON. """
+    return data if data is None else data.decode("latin-1")
+
+
+def _bytes(text):
+    """ Undo _text. """
+    return text if text is None else text.encode("latin-1")
+
+
+class DiskCache:
+    """ A cache tier for large responses, the bodies are appended to segment files and
+    served from there with sendfile(2), or from an mmap of the segment if sendfile is not
+    available. The index lives in memory, backed by a journal of JSON lines that's
+    compacted at start up. A response is written to disk while it is relayed to the
+    first client. The space is reclaimed a whole segment at a time, oldest first.
+    """
+    def __init__(self, directory, budget=1024 * 1024 * 1024, segment_size=64 * 1024 * 1024, max_object=None):
+        self.directory = directory
+        self.budget = budget
+        self.segment_size = segment_size
+        self.max_object = max_object or min(segment_size, budget / 4)
+        self.lock = threading.Lock()
+        self.entries = {}                               # key -> DiskEntry
+        self.urls = {}                                  # URL -> [Vary header names, entries]
+        self.segments = collections.OrderedDict()       # id -> _Segment, oldest first
+        self.writable = []                              # segments with room and no fill in progress
+        self.next_id = 0
+        self.journal = None
+        self.hits = 0
+        self.hit_bytes = 0
+        self.stores = 0
+        self.aborted = 0
+        self.evicted = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load()
+
+    def lookup(self, url, request):
+        with self.lock:
+            known = self.urls.get(url)
+            if known is None:
+                return None
+            return self.entries.get(cache_key(url, request, known[0]))
+
+    def fill(self):
+        """ Start storing a response body.
+        :return: A sink for TeeOutputStream, or None
+        """
+        with self.lock:
+            if len(self.writable):
+                segment = self.writable.pop()
+            else:
+                segment = self._create_segment()
+        if segment is None:
+            return None
+        return _DiskFill(self, segment)
+
+    def refresh(self, entry, response, now):
+        fresh = DiskEntry(entry.key, entry.vary, not_modified_response(entry, response),
+                          entry.segment, entry.offset, entry.length, now)
+        with self.lock:
+            if self.entries.get(entry.key) is entry:
+                self.entries[entry.key] = fresh
+                self._journal(fresh)
+        return fresh
+
+    def send(self, entry, output):
+        """ Write the body of an entry to an HttpOutputStream. """
+        try:
+            fd = os.open(entry.segment.path, os.O_RDONLY)
+        except OSError:
+            raise IOException("Disk cache segment is gone: " + entry.segment.path)
+        try:
+            if sendfile is not None:
+                offset, end = entry.offset, entry.offset + entry.length
+                # A shaped client is charged a piece at a time
+                piece = end - offset if output.client is None else 256 * 1024
+                while offset < end:
+                    if output.client is not None:
+                        output.pace(min(piece, end - offset))
+                    try:
+                        n = sendfile(output.conn.fileno(), fd, offset, min(piece, end - offset))
+                    except OSError, e:
+                        if e.errno not in (errno.EAGAIN, errno.EINTR):
+                            raise IOException("sendfile failed: " + os.strerror(e.errno))
+                        # The socket timeout makes the fd non-blocking, wait as a blocking send would
+                        if not wait_writable(output.conn, output.conn.gettimeout()):
+                            raise TimeoutException("body", "Connection stalled for %gs." % output.conn.gettimeout())
+                        continue
+                    if n <= 0:
+                        raise IOException("Connection closed before write complete.")
+                    offset += n
+                    output.sent += n
+                return
+            import mmap
+            m = mmap.mmap(fd, entry.offset + entry.length, access=mmap.ACCESS_READ)
+            try:
+                offset = entry.offset
+                while offset < entry.offset + entry.length:
+                    n = min(256 * 1024, entry.offset + entry.length - offset)
+                    output.write(buffer(m, offset, n))
+                    offset += n
+            finally:
+                m.close()
+        finally:
+            os.close(fd)
+
+    def served(self, entry):
+        with self.lock:
+            self.hits += 1
+            self.hit_bytes += entry.length
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "segments": len(self.segments),
+                "bytes": sum([seg.size for seg in self.segments.values()]),
+                "budget": self.budget,
+                "hits": self.hits,
+                "hit_bytes": self.hit_bytes,
+                "stores": self.stores,
+                "aborted": self.aborted,
+                "evicted": self.evicted,
+            }
+
+    def _commit(self, fill, url, request, response, now):
+        vary = vary_names(response)
+        entry = DiskEntry(cache_key(url, request, vary), vary, response, fill.segment, fill.offset, fill.length, now)
+        with self.lock:
+            try:
+                self._index(url, entry)
+                self._journal(entry)
+                self.stores += 1
+            finally:
+                self._put_back(fill.segment)
+
+    def _release(self, fill):
+        with self.lock:
+            self.aborted += 1
+            self._put_back(fill.segment)
+
+    def _put_back(self, segment):
+        # Lock must be held. The fill is over, the segment either takes more or is sealed.
+        segment.size = os.fstat(segment.fd).st_size
+        if segment.size < self.segment_size:
+            self.writable.append(segment)
+        else:
+            os.close(segment.fd)
+            segment.fd = None
+        self._evict()
+
+    def _index(self, url, entry):
+        # Lock must be held
+        old = self.entries.get(entry.key)
+        if old is not None:
+            self._forget(old)
+        self.entries[entry.key] = entry
+        entry.segment.keys.add(entry.key)
+        known = self.urls.setdefault(url, [entry.vary, 0])
+        known[0] = entry.vary
+        known[1] += 1
+
+    def _forget(self, entry):
+        # Lock must be held
+        del self.entries[entry.key]
+        entry.segment.keys.discard(entry.key)
+        known = self.urls[entry.key[0]]
+        known[1] -= 1
+        if not known[1]:
+            del self.urls[entry.key[0]]
+
+    def _evict(self):
+        # Lock must be held. Drop the oldest segments that are not being written.
+        total = sum([seg.size for seg in self.segments.values()])
+        for segment in list(self.segments.values()):
+            if total <= self.budget:
+                break
+            if segment.fd is not None and segment not in self.writable:
+                continue
+            if segment in self.writable:
+                self.writable.remove(segment)
+            self._drop(segment)
+            total -= segment.size
+            self.evicted += 1
+
+    def _drop(self, segment):
+        # Lock must be held
+        for key in list(segment.keys):
+            self._forget(self.entries[key])
+        del self.segments[segment.id]
+        if segment.fd is not None:
+            os.close(segment.fd)
+            segment.fd = None
+        try:
+            os.remove(segment.path)
+        except OSError:
+            pass
+
+    def _create_segment(self):
+        # Lock must be held
+        segment = _Segment(self.next_id, os.path.join(self.directory, "%08d.seg" % self.next_id))
+        try:
+            segment.fd = os.open(segment.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        except OSError, e:
+            warn("Can't create disk cache segment: " + os.strerror(e.errno))
+            return None
+        self.next_id += 1
+        self.segments[segment.id] = segment
+        return segment
+
+    def _journal(self, entry):
+        # Lock must be held. The strings are bytes of any value, JSON takes them as latin-1 text.
+        record = {
+            "url": _text(entry.key[0]), "vary": [_text(v) for v in entry.vary], "values": [_text(v) for v in entry.key[1]],
+            "segment": entry.segment.id, "offset": entry.offset, "length": entry.length,
+            "head": _text(entry.start_line + "\r\n" + str(entry.headers)), "stored": entry.stored,
+        }
+        self.journal.write(json.dumps(record) + "\n")
+        self.journal.flush()
+
+    def _load(self):
+        """ Rebuild the index from the journal and the segment files, then compact the journal. """
+        names = sorted([n for n in os.listdir(self.directory) if n.endswith(".seg")])
+        for name in names:
+            try:
+                id = int(name[:-4])
+            except ValueError:
+                continue
+            segment = _Segment(id, os.path.join(self.directory, name))
+            segment.size = os.path.getsize(segment.path)
+            self.segments[id] = segment
+            self.next_id = id + 1
+        path = os.path.join(self.directory, "journal")
+        if os.path.exists(path):
+            with open(path) as f:
+                for ln in f:
+                    try:
+                        r = json.loads(ln)
+                        segment = self.segments.get(r["segment"])
+                        if segment is None or r["offset"] + r["length"] > segment.size:
+                            continue
+                        head = _bytes(r["head"])
+                        response = HttpResponse()
+                        lines = head.split("\r\n")
+                        response.start_line = lines[0]
+                        for line in lines[1:]:
+                            if line:
+                                response.add_header_line(line)
+                        key = (_bytes(r["url"]), tuple([_bytes(v) for v in r["values"]]))
+                        vary = tuple([_bytes(v) for v in r["vary"]])
+                        entry = DiskEntry(key, vary, response, segment, r["offset"], r["length"], r["stored"])
+                        self._index(key[0], entry)
+                    except (ValueError, KeyError, TypeError, UnicodeError):
+                        continue
+        self.journal = open(path + ".new", "w")
+        for entry in self.entries.values():
+            self._journal(entry)
+        os.rename(path + ".new", path)
+        log("Disk cache at %s: %d entries in %d segments" % (self.directory, len(self.entries), len(self.segments)))
+
+
+# Shared response cache, None if caching is disabled
+response_cache = None
+
+
+class _FlightReader:
+    def __init__(self, flight, request):
+        self.flight = flight
+        self.request = request
+        self.cursor = 0         # absolute index of the next part to read
+        self.cut = False        # dropped for lagging too far behind
+
+    def head(self):
+        """ Wait for the response header.
+        :return: The response, or None if it can't be shared and the request must be sent alone
+        """
+        return self.flight.wait_head(self)
+
+    def next(self):
+        """ Wait for more of the response body.
+        :return: A part of the body as received, or "" at the end
+        """
+        return self.flight.next(self)
+
+
+class _Flight:
+    """ A response being fetched for the first of concurrent identical requests and
+    relayed, while it's received, to the handlers of the requests that came along.
+    The body is kept as a list of parts, parts are dropped once all readers are past
+    them. A reader lagging more than MAX_LAG bytes behind is dropped.
+    """
+    MAX_LAG = 8 * 1024 * 1024
+
+    def __init__(self, url, request):
+        self.url = url
+        self.request = request
+        self.started = time.time()
+        self.cond = threading.Condition()
+        self.response = None
+        self.shared = True      # False once the response turned out not shareable
+        self.parts = []
+        self.first = 0          # absolute index of parts[0]
+        self.buffered = 0       # bytes in parts
+        self.readers = []
+        self.cut = 0            # readers dropped for lagging behind
+        self.done = None        # True once the whole body is in, False on failure
+
+    def joinable(self, now, window):
+        # Lock of RequestCollapser must be held
+        return self.shared and self.done is None and self.first == 0 and now - self.started <= window
+
+    def publish(self, request, response):
+        """ Hand the response header over to the readers. """
+        with self.cond:
+            self.response = response
+            self.shared = shareable(request, response)
+            if not self.shared:
+                self.readers = []
+            self.cond.notify_all()
+        return self.shared
+
+    def put(self, data):
+        if not isinstance(data, str):
+            data = memoryview(data).tobytes()
+        with self.cond:
+            self.parts.append(data)
+            self.buffered += len(data)
+            self._trim()
+            self.cond.notify_all()
+
+    def close(self, complete):
+        with self.cond:
+            self.done = complete
+            self.cond.notify_all()
+
+    def leave(self, reader):
+        with self.cond:
+            if reader in self.readers:
+                self.readers.remove(reader)
+                self._trim()
+
+    def wait_head(self, reader):
+        with self.cond:
+            while self.response is None and self.done is None:
+                self.cond.wait()
+            if self.response is None or not self.shared:
+                return None
+            if vary_names(self.response):
+                # The response may depend on the request headers named by Vary
+                vary = vary_names(self.response)
+                if cache_key(self.url, reader.request, vary) != cache_key(self.url, self.request, vary):
+                    self.readers.remove(reader)
+                    return None
+            return self.response
+
+    def next(self, reader):
+        with self.cond:
+            while True:
+                if reader.cut:
+                    raise IOException("Lagging too far behind a collapsed response")
+                if reader.cursor < self.first + len(self.parts):
+                    data = self.parts[reader.cursor - self.first]
+                    reader.cursor += 1
+                    self._trim()
+                    return data
+                if self.done is not None:
+                    self.readers.remove(reader)
+                    if not self.done:
+                        raise IOException("Collapsed response failed")
+                    return ""
+                self.cond.wait()
+
+    def _trim(self):
+        # Lock must be held. Drop the parts all readers are done with, and the slowest readers
+        # if the rest is too much. Without readers, parts are kept for joining until MAX_LAG.
+        if len(self.readers):
+            low = min([r.cursor for r in self.readers])
+        else:
+            low = self.first + len(self.parts) if self.buffered > _Flight.MAX_LAG else self.first
+        while self.first < low:
+            self.buffered -= len(self.parts.pop(0))
+            self.first += 1
+        while self.buffered > _Flight.MAX_LAG and len(self.readers):
+            for r in [r for r in self.readers if r.cursor == self.first]:
+                r.cut = True
+                self.readers.remove(r)
+                self.cut += 1
+            self.buffered -= len(self.parts.pop(0))
+            self.first += 1
+
+
+class FlightOutputStream(HttpOutputStream):
+    """ An output stream that writes through to another one and hands what is written to
+    the readers of a flight. If the client of the leading request goes away, the response
+    is still read to the end for the readers, lost is set and writing is skipped.
+    """
+    def __init__(self, out, flight):
+        HttpOutputStream.__init__(self, out.conn)
+        self.out = out
+        self.flight = flight
+        self.lost = None
+
+    def write(self, data, flags=0):
+        self.flight.put(data)
+        if self.lost is not None:
+            return
+        try:
+            self.out.write(data, flags)
+        except (IOException, socket.error), e:
+            if not len(self.flight.readers):
+                raise
+            self.lost = e
+
+
+class RequestCollapser:
+    """ Collapsed forwarding: while a GET is being fetched, identical requests arriving
+    within window seconds don't go to the origin but are answered with the same response,
+    up to max_readers of them per fetch. Only shareable responses are handed over, the
+    others send their own request once the response header shows it.
+    """
+    def __init__(self, window=1.0, max_readers=64):
+        self.window = window
+        self.max_readers = max_readers
+        self.lock = threading.Lock()
+        self.flights = {}               # URL -> _Flight
+        self.leaders = 0
+        self.followers = 0
+        self.full = 0
+        self.fallbacks = 0
+        self.cut = 0
+
+    def collapsible(self, request):
+        if request.method() != "GET" or request.body_pending or len(request.body):
+            return False
+        for key in ("Authorization", "Range", "If-Range", "If-None-Match", "If-Modified-Since"):
+            if request.has(key):
+                return False
+        return True
+
+    def attach(self, url, request):
+        """ Find a fetch of url to follow, or start one.
+        :return: (flight, None) to lead a new fetch, (None, reader) to follow one, or
+         (None, None) if all fetches of url are full and the request must be sent alone.
+        """
+        now = time.time()
+        with self.lock:
+            flight = self.flights.get(url)
+            if flight is not None and flight.joinable(now, self.window):
+                with flight.cond:
+                    if len(flight.readers) < self.max_readers:
+                        reader = _FlightReader(flight, request)
+                        flight.readers.append(reader)
+                        self.followers += 1
+                        return None, reader
+                self.full += 1
+                return None, None
+            flight = _Flight(url, request)
+            self.flights[url] = flight
+            self.leaders += 1
+            return flight, None
+
+    def finish(self, flight, complete):
+        flight.close(complete)
+        with self.lock:
+            if self.flights.get(flight.url) is flight:
+                del self.flights[flight.url]
+            self.cut += flight.cut
+
+    def fallback(self):
+        with self.lock:
+            self.fallbacks += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "flights": len(self.flights),
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "full": self.full,
+                "fallbacks": self.fallbacks,
+                "cut": self.cut,
+            }
+
+
+# Shared collapsed forwarding of GET requests, None if disabled
+collapser = None
+
+
+class Rule:
+    """ A rule of a rule file: action applies to the requests matching pattern, which is
+    kind "domain" (a host and its subdomains), "host" (that host only), "prefix" (URLs
+    starting with it) or "contains" (URLs containing it). Patterns are lower cased.
+    """
+    def __init__(self, action, pattern, kind, line=0):
+        self.action = action
+        self.pattern = pattern
+        self.kind = kind
+        self.line = line
+        self.hits = 0
+
+    def __str__(self):
+        return self.action + " " + self.text()
+
+    def text(self):
+        """ Get the pattern as written in a rule file. """
+        if self.kind == "domain":
+            return "." + self.pattern
+        if self.kind == "contains":
+            return "*" + self.pattern
+        return self.pattern
+
+
+def parse_rule(line, number=0):
+    """ Parse a rule file line "action pattern", see RuleSet.
+    :return: A Rule, or None for a blank or comment line
+    :raise ValueError: if the line isn't a valid rule
+    """
+    fields = line.split("#", 1)[0].split()
+    if not fields:
+        return None
+    if len(fields) != 2 or fields[0] not in RuleSet.GROUPS:
+        raise ValueError("Bad rule at line %d: %s" % (number, line.strip()))
+    action, pattern = fields[0], fields[1].lower()
+    if pattern.startswith("*"):
+        kind, pattern = "contains", pattern.strip("*")
+    elif "/" in pattern:
+        kind = "prefix"
+    elif pattern.startswith("."):
+        kind, pattern = "domain", pattern[1:]
+    else:
+        kind = "host"
+    if not pattern or (kind in ("domain", "host") and "" in pattern.split(".")):
+        raise ValueError("Bad rule pattern at line %d: %s" % (number, fields[1]))
+    return Rule(action, pattern, kind, number)
+
+
+class RuleSet:
+    """ Rules compiled for lookups whose cost doesn't grow with their number.
+    Host rules are in a trie of domain labels, from the top level domain down, a lookup
+    walks the labels of a host once. URL rules are in an Aho-Corasick automaton, a lookup
+    scans a URL once whatever the number of patterns, prefix rules only count when their
+    match starts at the beginning of the URL.
+    Each action belongs to a group, a request gets at most one action per group: the one
+    of the URL rule with the longest pattern if one matches, else the one of the host rule
+    with the longest pattern. A rule set is never changed once built, so that it can be
+    shared by all handlers and replaced as a whole.
+    """
+    GROUPS = {"block": "access", "allow": "access", "bypass": "cache", "direct": "route", "parent": "route"}
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.matched = 0
+        # Host trie: node = [children: label -> node, domain rules: group -> rule, host rules: group -> rule]
+        self.hosts = [{}, {}, {}]
+        # Aho-Corasick automaton, states are indexes into the lists
+        self.goto = [{}]            # state -> {character -> state}
+        self.fail = [0]             # state -> longest proper suffix state
+        self.out = [None]           # state -> rules whose pattern ends here
+        self.link = [0]             # state -> nearest suffix state with rules, 0 for none
+        for rule in rules:
+            if rule.kind in ("domain", "host"):
+                self._add_host(rule)
+            else:
+                self._add_url(rule)
+        self._link()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, host, url=None, count=True):
+        """ Find the actions that apply to a request.
+        :param url: The absolute URL of the request, None for CONNECT
+        :param count: Count the hits of the rules
+        :return: A dict of group -> action
+        """
+        found = {}
+        node = self.hosts
+        for label in reversed(host.lower().split(".")):
+            node = node[0].get(label)
+            if node is None:
+                break
+            # A deeper node has a longer pattern
+            found.update(node[1])
+        else:
+            found.update(node[2])
+        if url is not None and len(self.goto) > 1:
+            found.update(self._scan(url.lower()))
+        if count:
+            with self.lock:
+                self.lookups += 1
+                if found:
+                    self.matched += 1
+                for rule in found.values():
+                    rule.hits += 1
+        return dict([(group, rule.action) for group, rule in found.items()])
+
+    def _scan(self, url):
+        """ Get the URL rule with the longest pattern matching url, per group. """
+        goto, fail, out, link = self.goto, self.fail, self.out, self.link
+        best = {}
+        s = 0
+        for i, ch in enumerate(url):
+            t = goto[s].get(ch)
+            while t is None and s:
+                s = fail[s]
+                t = goto[s].get(ch)
+            s = t or 0
+            hit = s if out[s] is not None else link[s]
+            while hit:
+                for rule in out[hit]:
+                    if rule.kind == "prefix" and len(rule.pattern) != i + 1:
+                        continue
+                    group = RuleSet.GROUPS[rule.action]
+                    other = best.get(group)
+                    if other is None or len(rule.pattern) > len(other.pattern):
+                        best[group] = rule
+                hit = link[hit]
+        return best
+
+    def _add_host(self, rule):
+        node = self.hosts
+        for label in reversed(rule.pattern.split(".")):
+            node = node[0].setdefault(label, [{}, {}, {}])
+        node[1 if rule.kind == "domain" else 2][RuleSet.GROUPS[rule.action]] = rule
+
+    def _add_url(self, rule):
+        s = 0
+        for ch in rule.pattern:
+            t = self.goto[s].get(ch)
+            if t is None:
+                t = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(None)
+                self.link.append(0)
+                self.goto[s][ch] = t
+            s = t
+        self.out[s] = (self.out[s] or []) + [rule]
+
+    def _link(self):
+        # Breadth first, the failure state of a state is known before its children's
+        pending = collections.deque(self.goto[0].values())
+        while pending:
+            s = pending.popleft()
+            for ch, t in self.goto[s].iteritems():
+                pending.append(t)
+                f = self.fail[s]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(ch, 0) if s else 0
+                self.fail[t] = f
+                self.link[t] = f if self.out[f] is not None else self.link[f]
+
+
+def load_rules(path):
+    """ Read and compile a rule file, see RuleSet.
+    :return: A tuple (RuleSet, list of the errors of the lines left out)
+    """
+    rules, errors = [], []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            try:
+                rule = parse_rule(line, number)
+            except ValueError, e:
+                errors.append(str(e))
+                continue
+            if rule is not None:
+                rules.append(rule)
+    return RuleSet(rules), errors
+
+
+class RuleFile:
+    """ The rules of a file, reloaded when the file changes. The file is checked every
+    interval seconds and compiled in a background thread, lookups go on with the previous
+    rule set meanwhile, which is then replaced by the new one at once. A rule keeps its hit
+    count across reloads if it's still in the file.
+    The file has a rule per line: an action then a pattern, # starts a comment.
+    Actions: block (answer 403), allow (overrides block), bypass (the response cache),
+    direct (connect to the origin although there are parent proxies), parent (overrides direct).
+    Patterns: .example.com for the host and its subdomains, example.com for that host
+    only, http://example.com/path for URLs starting with it, *text for URLs containing it.
+    """
+    def __init__(self, path, interval=5.0):
+        self.path = path
+        self.interval = interval
+        self.stamp = self._stamp()
+        self.current = self._load()
+        self.lock = threading.Lock()
+        self.reloads = 0
+        self.failures = 0
+
+    def start(self):
+        t = threading.Thread(target=self._watch)
+        t.daemon = True
+        t.start()
+
+    def match(self, host, url=None, count=True):
+        return self.current.match(host, url, count)
+
+    def stats(self):
+        current = self.current
+        with current.lock:
+            lookups, matched = current.lookups, current.matched
+        with self.lock:
+            return {"rules": len(current), "lookups": lookups, "matched": matched,
+                    "reloads": self.reloads, "failures": self.failures}
+
+    def hits(self):
+        """ Get the hit counts of the rules that have been hit, by rule text. """
+        current = self.current
+        with current.lock:
+            return dict([(str(rule), rule.hits) for rule in current.rules if rule.hits])
+
+    def _stamp(self):
+        st = os.stat(self.path)
+        return st.st_mtime, st.st_size, st.st_ino
+
+    def _load(self):
+        rules, errors = load_rules(self.path)
+        for e in errors:
+            warn(e)
+        log("Loaded %d rules from %s" % (len(rules), self.path))
+        return rules
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                stamp = self._stamp()
+                if stamp == self.stamp:
+                    continue
+                self.stamp = stamp
+                rules = self._load()
+            except (IOError, OSError), e:
+                warn("Failed to reload rules from %s: %s" % (self.path, e))
+                with self.lock:
+                    self.failures += 1
+                continue
+            old = self.current
+            with old.lock:
+                counts = dict([((rule.action, rule.kind, rule.pattern), rule.hits) for rule in old.rules])
+                rules.lookups, rules.matched = old.lookups, old.matched
+            for rule in rules.rules:
+                rule.hits = counts.get((rule.action, rule.kind, rule.pattern), 0)
+            self.current = rules
+            with self.lock:
+                self.reloads += 1
+
+
+# Rules applied to requests, None if there are none
+rule_file = None
+
+
+class Histogram:
+    """ Counts of durations in log-linear buckets, HDR style: values are microseconds, the
+    ones below 2 * SUB_BUCKETS have a bucket each, above that every power of two is split in
+    SUB_BUCKETS buckets, so a value is known within 1/SUB_BUCKETS of itself. Recording is a
+    few integer operations under a lock.
+    A snapshot is a list [sum of the seconds recorded, count of bucket 0, count of bucket 1, ...],
+    snapshots of several processes are added up element by element.
+    """
+    SUB_BITS = 3
+    SUB_BUCKETS = 1 << SUB_BITS
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (4 * Histogram.SUB_BUCKETS)
+        self.sum = 0.0
+
+    @staticmethod
+    def index(us):
+        if us < 2 * Histogram.SUB_BUCKETS:
+            return us
+        shift = us.bit_length() - Histogram.SUB_BITS - 1
+        return (shift + 1) * Histogram.SUB_BUCKETS + (us >> shift) - Histogram.SUB_BUCKETS
+
+    @staticmethod
+    def lower(i):
+        """ Get the smallest microseconds counted in bucket i. """
+        if i < 2 * Histogram.SUB_BUCKETS:
+            return i
+        shift = i / Histogram.SUB_BUCKETS - 1
+        return (i - shift * Histogram.SUB_BUCKETS) << shift
+
+    def record(self, seconds):
+        i = Histogram.index(max(int(seconds * 1000000), 0))
+        with self.lock:
+            if i >= len(self.counts):
+                self.counts.extend([0] * (i + 1 - len(self.counts)))
+            self.counts[i] += 1
+            self.sum += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return [self.sum] + self.counts
+
+    @staticmethod
+    def count(snapshot):
+        return sum(snapshot[1:])
+
+    @staticmethod
+    def below(snapshot, seconds):
+        """ Count the values of a snapshot known to be at most seconds. """
+        us = seconds * 1000000
+        n = 0
+        for i, c in enumerate(snapshot[1:]):
+            if Histogram.lower(i + 1) - 1 > us:
+                break
+            n += c
+        return n
+
+    @staticmethod
+    def percentile(snapshot, q):
+        """ Get the seconds below which a fraction q of the values of a snapshot lie, at the
+        middle of the bucket holding it. """
+        rank = q * Histogram.count(snapshot)
+        n = 0
+        for i, c in enumerate(snapshot[1:]):
+            n += c
+            if c and n >= rank:
+                return (Histogram.lower(i) + Histogram.lower(i + 1) - 1) / 2.0 / 1000000
+        return 0.0
+
+
+class ProxyMetrics:
+    """ Latency histograms of the stages of serving requests, and counters of the handlers.
+    Stages of a request: dns (name lookup), connect (to the origin), ttfb (request sent to
+    response header received), body (response body relayed) and request (the whole request,
+    except CONNECT). Of a CONNECT request: dns, connect and tunnel_setup (until the tunnel
+    is relaying). Before either, queue_wait: a connection waiting for a free thread.
+    """
+    STAGES = ("queue_wait", "dns", "connect", "ttfb", "body", "request", "tunnel_setup")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = dict([(name, Histogram()) for name in ProxyMetrics.STAGES])
+        self.opened = 0             # client connections
+        self.closed = 0
+        self.active = 0             # requests being handled
+        self.requests = 0
+        self.bytes = 0              # sent to clients, tunnels aside
+
+    def record(self, stage, seconds):
+        self.stages[stage].record(seconds)
+
+    def connection(self, opened):
+        with self.lock:
+            if opened:
+                self.opened += 1
+            else:
+                self.closed += 1
+
+    def begin(self):
+        with self.lock:
+            self.active += 1
+            self.requests += 1
+
+    def end(self, count):
+        with self.lock:
+            self.active -= 1
+            self.bytes += count
+
+    def stats(self):
+        with self.lock:
+            return {
+                "connections": self.opened - self.closed,
+                "active": self.active,
+                "requests": self.requests,
+                "bytes": self.bytes,
+            }
+
+    def stage_stats(self):
+        return dict([(name, h.snapshot()) for name, h in self.stages.items()])
+
+
+# Histograms and counters of the handlers
+metrics = ProxyMetrics()
+
+
+class Timeouts:
+    """ How long a peer may keep a connection waiting, in seconds, None for no limit, and
+    counters of the connections closed when a limit ran out:
+    connect: connecting to an origin.
+    header: the rest of a request header part once its first bytes are in.
+    body: a receive or send making no progress, a response awaited from an origin included.
+    keep_alive: a client connection waiting for its next request.
+    tunnel: a CONNECT tunnel without traffic, see --tunnel-idle.
+    """
+    KINDS = ("connect", "header", "body", "keep_alive", "tunnel")
+
+    def __init__(self, connect=30.0, header=60.0, body=300.0, keep_alive=75.0):
+        self.connect = connect or None
+        self.header = header or None
+        self.body = body or None
+        self.keep_alive = keep_alive or None
+        self.lock = threading.Lock()
+        self.counts = dict([(kind, 0) for kind in Timeouts.KINDS])
+
+    def expired(self, kind):
+        with self.lock:
+            self.counts[kind] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+# Time limits of client and upstream connections
+timeouts = Timeouts()
+
+
+class TokenBucket:
+    """ Admits rate bytes per second on average and bursts of up to burst bytes. Taking more
+    than is available runs the bucket into debt, which is paid back in -tokens/rate seconds.
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, n, now):
+        """ Take n tokens.
+        :return: Seconds until the bucket is out of debt
+        """
+        self.refill(now)
+        self.tokens -= n
+        return max(0.0, -self.tokens / self.rate)
+
+    def full(self, now):
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class Shaper:
+    """ Rate limits on the bytes relayed to clients, a token bucket per client address and
+    one over all clients, in bytes per second, 0 for no limit. Buckets allow BURST seconds
+    of their rate at once.
+    Senders aren't held back for every write, a client may run up to SLACK seconds of debt
+    before its sender waits for the whole debt, so a shaped connection pauses a few times a
+    second at most whatever the size of its writes.
+    The global bucket is charged in the order senders come, a sender waits for the bytes
+    charged before its own, which keeps clients within the global limit in turn.
+    Tunnels don't wait at all, the remote side of a held tunnel isn't read until its time.
+    Buckets of clients that have been quiet long enough to fill up again are dropped.
+    """
+    BURST = 0.25
+    SLACK = 0.05
+
+    def __init__(self, client_rate=0, total_rate=0):
+        self.client_rate = client_rate
+        self.total_rate = total_rate
+        self.lock = threading.Lock()
+        self.buckets = collections.OrderedDict()    # client address -> TokenBucket, least recently used first
+        self.total = None
+        if total_rate:
+            self.total = TokenBucket(total_rate, Shaper.burst(total_rate), time.time())
+        self.bytes = 0
+        self.throttled = 0          # times a sender was held back
+        self.throttled_time = 0.0   # seconds senders were held back in total
+
+    @staticmethod
+    def burst(rate):
+        return max(int(rate * Shaper.BURST), 16 * 1024)
+
+    def take(self, client, n):
+        """ Charge n bytes sent to a client.
+        :return: Seconds the sender should hold back before sending more, 0 to go on
+        """
+        with self.lock:
+            now = time.time()
+            wait = 0.0
+            if self.client_rate:
+                bucket = self.buckets.pop(client, None)
+                if bucket is None:
+                    bucket = TokenBucket(self.client_rate, Shaper.burst(self.client_rate), now)
+                self.buckets[client] = bucket
+                wait = bucket.take(n, now)
+                self._expire(now)
+            if self.total is not None:
+                wait = max(wait, self.total.take(n, now))
+            self.bytes += n
+            if wait < Shaper.SLACK:
+                return 0.0
+            self.throttled += 1
+            self.throttled_time += wait
+            return wait
+
+    def _expire(self, now):
+        while len(self.buckets):
+            client, bucket = next(self.buckets.iteritems())
+            if not bucket.full(now):
+                break
+            del self.buckets[client]
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            tokens = 0
+            if self.total is not None:
+                self.total.refill(now)
+                tokens = int(self.total.tokens)
+            return {
+                "clients": len(self.buckets),
+                "client_rate": self.client_rate,
+                "total_rate": self.total_rate,
+                "total_tokens": tokens,
+                "bytes": self.bytes,
+                "throttled": self.throttled,
+                "throttled_seconds": round(self.throttled_time, 3),
+            }
+
+
+# Bandwidth limits of the bytes relayed to clients, None if there are none
+shaper = None
+
+
+class Compressor:
+    """ Compresses response bodies with gzip for clients that accept it, see GzipOutputStream.
+    A response is compressed if it's a 200 to an HTTP/1.1 request other than HEAD whose
+    Accept-Encoding takes gzip, it has neither Content-Encoding nor Cache-Control: no-transform,
+    it's of a textual type and its body is chunked or has a length of at least min_size.
+    Bodies delimited by the end of the connection are left alone.
+    The level is adjusted once a second from the CPU time compressing took: a step down when
+    it took more than cpu_budget of a core, a step up to max_level when it took less than
+    half of it. At level 0 responses are sent as they are until the load has dropped.
+    """
+    TYPES = ("text/", "application/json", "application/javascript", "application/x-javascript",
+             "application/xml", "image/svg+xml")
+    SUFFIXES = ("+json", "+xml")
+    EXCLUDED = ("text/event-stream",)
+    # Header fields that don't hold for the compressed body
+    DROPPED = ("Content-Length", "Transfer-Encoding", "Content-MD5", "Accept-Ranges")
+
+    def __init__(self, min_size=1024, cpu_budget=0.5, max_level=6):
+        self.min_size = min_size
+        self.cpu_budget = cpu_budget
+        self.max_level = max_level
+        self.level = max_level
+        self.lock = threading.Lock()
+        self.window = time.time()   # start of the second the CPU time is added up for
+        self.window_cpu = 0.0
+        self.load = 0.0             # share of a core spent compressing over the last second
+        self.small = 0              # eligible responses shorter than min_size
+        self.over_budget = 0        # eligible responses sent as they are at level 0
+        self.types = {}             # content type family -> [responses, bytes in, bytes out, CPU seconds]
+
+    @staticmethod
+    def accepts(value):
+        """ Test whether an Accept-Encoding value takes gzip, see RFC7231 Section 5.3.4. """
+        for coding in value.split(","):
+            params = coding.split(";")
+            if params[0].strip(" \t").lower() not in ("gzip", "x-gzip", "*"):
+                continue
+            for p in params[1:]:
+                k, _, v = p.partition("=")
+                if k.strip(" \t").lower() == "q":
+                    try:
+                        return float(v) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
+
+    def eligible(self, request, resp):
+        """ Test whether a response may be compressed for a request, whatever its length.
+        :return: The content type of the response, None if it may not
+        """
+        if request.method() == "HEAD" or request.version() != "HTTP/1.1" or resp.code() != 200:
+            return None
+        if not Compressor.accepts(request.get("Accept-Encoding", "")):
+            return None
+        if resp.get("Content-Encoding", "identity").strip(" \t").lower() != "identity":
+            return None
+        if "no-transform" in parse_cache_control(", ".join(resp.headers.getall("Cache-Control"))):
+            return None
+        ctype = resp.get("Content-Type", "").split(";", 1)[0].strip(" \t").lower()
+        if ctype in Compressor.EXCLUDED or not (ctype.startswith(Compressor.TYPES) or
+                                                 ctype.endswith(Compressor.SUFFIXES)):
+            return None
+        return ctype
+
+    def encoder(self, request, resp, out):
+        """ Get a stream compressing the body of resp into out, None if it's to be sent as it is.
+        The head attribute of the stream is the header part to send instead of resp's.
+        """
+        ctype = self.eligible(request, resp)
+        if ctype is None:
+            return None
+        encoding = resp.get("Transfer-Encoding")
+        chunked = encoding is not None
+        if chunked and encoding.strip(" \t").lower() != "chunked":
+            return None
+        if not chunked:
+            length = len(resp.body) if not resp.body_pending else resp.get_int("Content-Length", -1)
+            if length < 0:
+                return None
+            if length < self.min_size:
+                with self.lock:
+                    self.small += 1
+                return None
+        with self.lock:
+            level = self._adjust(time.time())
+            if not level:
+                self.over_budget += 1
+                return None
+        stream = GzipOutputStream(out, self, level, ctype, chunked)
+        stream.head = Compressor.head(resp)
+        return stream
+
+    @staticmethod
+    def head(resp):
+        """ Make the header part of resp for its body compressed in chunked coding. """
+        h = HttpResponse()
+        h.set_status_line("HTTP/1.1 " + resp.start_line.split(" ", 1)[1])
+        h.headers.extend(list(resp.headers))
+        for key in Compressor.DROPPED:
+            h.headers.delete(key)
+        h.add("Content-Encoding", "gzip")
+        h.add("Transfer-Encoding", "chunked")
+        vary = ", ".join(resp.headers.getall("Vary"))
+        if not vary:
+            h.headers.set("Vary", "Accept-Encoding")
+        elif "accept-encoding" not in vary.lower() and vary.strip(" \t") != "*":
+            h.headers.set("Vary", vary + ", Accept-Encoding")
+        etag = resp.get("ETag")
+        if etag is not None and not etag.startswith("W/"):
+            # Not the same bytes as the origin's representation any more
+            h.headers.set("ETag", "W/" + etag)
+        return h
+
+    def _adjust(self, now):
+        elapsed = now - self.window
+        if elapsed >= 1.0:
+            self.load = self.window_cpu / elapsed
+            if self.load > self.cpu_budget:
+                self.level = max(self.level - 1, 0)
+            elif self.load < self.cpu_budget / 2:
+                self.level = min(self.level + 1, self.max_level)
+            self.window, self.window_cpu = now, 0.0
+        return self.level
+
+    def spent(self, seconds):
+        with self.lock:
+            self.window_cpu += seconds
+
+    @staticmethod
+    def family(ctype):
+        """ Get the family an eligible content type is counted in, the types are chosen by the
+        origins so they're not counted one by one. """
+        for t in Compressor.TYPES:
+            if ctype.startswith(t):
+                return t + "*" if t.endswith("/") else t
+        for suffix in Compressor.SUFFIXES:
+            if ctype.endswith(suffix):
+                return "*" + suffix
+        return "other"
+
+    def finished(self, stream):
+        with self.lock:
+            t = self.types.setdefault(Compressor.family(stream.ctype), [0, 0, 0, 0.0])
+            t[0] += 1
+            t[1] += stream.raw
+            t[2] += stream.packed
+            t[3] += stream.cpu
+
+    def stats(self):
+        with self.lock:
+            totals = [sum(t[i] for t in self.types.values()) for i in range(0, 4)]
+            return {
+                "level": self.level,
+                "load": round(self.load, 3),
+                "compressed": totals[0],
+                "small": self.small,
+                "over_budget": self.over_budget,
+                "bytes_in": totals[1],
+                "bytes_out": totals[2],
+                "cpu_seconds": round(totals[3], 3),
+            }
+
+    def type_stats(self):
+        """ Get the counters per content type family, as "family:counter" -> value. """
+        with self.lock:
+            stats = {}
+            for ctype, t in self.types.items():
+                stats[ctype + ":compressed"] = t[0]
+                stats[ctype + ":bytes_in"] = t[1]
+                stats[ctype + ":bytes_out"] = t[2]
+                stats[ctype + ":cpu_seconds"] = round(t[3], 3)
+            return stats
+
+
+# Compression of response bodies, None if responses are sent as they are
+compressor = None
+
+
+def request_host(request):
+    """ Get the host a client request is for, from its target or else its Host header. """
+    target = request.target()
+    p = target.find("//")
+    if p == -1:
+        return target if request.method() == "CONNECT" else request.get("Host", "-")
+    q = target.find("/", p + 2)
+    return target[p + 2:] if q == -1 else target[p + 2:q]
+
+
+def client_keep_alive(request):
+    """ Test whether a client connection persists after the response to request. """
+    connspec = request.get("Proxy-Connection")
+    if connspec is not None:
+        return connspec.lower() == "keep-alive"
+    return HttpProxyHandler.KEEP_ALIVE_DEFAULT
+
+
+class HttpProxyHandler:
+    MAX_HEADER = 128 * 1024
+    KEEP_ALIVE_DEFAULT = True
+    PIPELINE_DEPTH = 8                  # requests read ahead and sent to the origin before their turn
+    SAFE_METHODS = ("GET", "HEAD")      # methods that are sent ahead, see RFC7230 Section 6.3.2
+
+    def __init__(self, s):
+        if timeouts.body is not None:
+            s.settimeout(timeouts.body)
+        self.client_conn = s
+        self.client_input = HttpInputStream(s, max_header=HttpProxyHandler.MAX_HEADER)
+        self.client_input.header_timeout = timeouts.header
+        self.client_output = HttpOutputStream(s)
+        if shaper is not None:
+            try:
+                self.client_output.client = s.getpeername()[0]
+            except socket.error:
+                pass
+        self.remote_addr = None
+        self.remote_conn = None
+        self.remote_input = None
+        self.remote_output = None
+        self.remote_reused = False      # remote_conn was taken from upstream_pool
+        self.remote_reusable = False    # remote_conn is at a message boundary and may be kept alive
+        self.detached = False           # client_conn has been handed over to tunnel_reactor
+        self.keep_alive = False         # client_conn persists after the current request
+        self.pipelined = collections.deque()    # (request, remote_conn it was sent over or None,
+                                                # parent it's outstanding at or None) read ahead
+        self.sent_ahead = None          # remote_conn the current request was sent over by read_ahead
+        self.status = None              # status code of the response to the current request
+        self.cacheable = True           # the current request may be answered from and stored in the cache
+        self.parent = None              # parent proxy the current request is outstanding at
+        self.client_addr = None         # "address:port" of the client, for the access log
+        self.wait_idle = True           # wait for the next request here, unless an event loop does it
+        self.cleaned = False
+        metrics.connection(True)
+
+    def run(self):
+        while self.step():
+            pass
+
+    def step(self):
+        """ Serve one request from the client connection.
+        :return: True if the client connection is kept alive for more requests, otherwise
+         the handler has been cleaned up and False is returned.
+        """
+        keep_alive = False
+        try:
+            keep_alive = self.serve_one()
+        except TimeoutException, e:
+            timeouts.expired(e.kind)
+            log(e.reason, level=5)
+        except IOException, e:
+            log(e.reason, level=5)
+        except socket.timeout:
+            # A send to a peer that stopped reading
+            timeouts.expired("body")
+        except Exception:
+            # TODO handle exceptions here
+            pass
+        if not keep_alive:
+            self.final_clean()
+        return keep_alive
+
+    def serve_one(self):
+        if len(self.pipelined):
+            r, self.sent_ahead, parent = self.pipelined.popleft()
+            self.use_parent(parent)
+        else:
+            r, self.sent_ahead = self.read_request(), None
+
+        self.keep_alive = client_keep_alive(r)
+        self.status = None
+        start, sent = time.time(), self.client_output.sent
+        metrics.begin()
+        try:
+            self.handle_request(r)
+        finally:
+            duration, count = time.time() - start, self.client_output.sent - sent
+            metrics.end(count)
+            if r.method() != "CONNECT":
+                metrics.record("request", duration)
+            if access_log is not None:
+                self.log_access(r, count, duration)
+            self.use_parent(None)
+        return self.keep_alive and not self.detached
+
+    def read_request(self):
+        """ Read the next request from the client, which may idle for the keep-alive timeout before it.
+        The read buffer goes back to buffer_pool while the client idles.
+        """
+        if self.wait_idle and not self.client_input.buffered() and not wait_readable(self.client_conn, 0):
+            self.client_input.release(idle=True)
+            if timeouts.keep_alive is not None and not wait_readable(self.client_conn, timeouts.keep_alive):
+                raise TimeoutException("keep_alive", "Client connection idle for %gs." % timeouts.keep_alive)
+        return self.client_input.read_request()
+
+    def log_access(self, request, count, duration):
+        if self.client_addr is None:
+            try:
+                self.client_addr = "%s:%d" % self.client_conn.getpeername()[:2]
+            except socket.error:
+                self.client_addr = "-"
+        log_access(self.client_addr, request.method(), request_host(request), self.status, count, duration)
+
+    def pending(self):
+        """ Test whether the client has sent data that is buffered but not handled yet. """
+        return len(self.pipelined) != 0 or self.client_input.buffered() != 0
+
+    def read_ahead(self, host, port):
+        """ Read the requests the client has pipelined and send them to host:port over the
+        remote connection, so that the origin works on them while earlier responses are relayed.
+        Sending ahead stops at a request that isn't safe to repeat, goes elsewhere, may be
+        answered from the cache or ends the connection, which is kept to be handled in turn.
+        """
+        for r, sent, parent in self.pipelined:
+            if sent is not self.remote_conn:
+                # Requests must reach the origin in order
+                return
+        while len(self.pipelined) < HttpProxyHandler.PIPELINE_DEPTH and self.client_input.has_message():
+            r = self.client_input.read_request()
+            sent, parent = None, None
+            if r.method() in HttpProxyHandler.SAFE_METHODS and not r.body_pending and not len(r.body) \
+                    and client_keep_alive(r):
+                h, p, fwd = self.forward_request(r)
+                verdict = {} if rule_file is None else rule_file.match(h, r.target(), count=False)
+                self.route(fwd, r, verdict)
+                if (h, p) == (host, port) and verdict.get("access") != "block" and \
+                        fwd.proxied == (self.parent is not None) and \
+                        (response_cache is None or r.method() != "GET" or response_cache.lookup(r.target(), r) is None):
+                    try:
+                        self.remote_output.writev(fwd.buffers())
+                        sent = self.remote_conn
+                    except (IOException, socket.error):
+                        pass
+                    if sent is not None and fwd.proxied:
+                        # Outstanding at the parent until its response has been relayed
+                        parent = self.parent
+                        parents.charge(parent)
+            self.pipelined.append((r, sent, parent))
+            if sent is None:
+                return
+
+    def close_remote(self):
+        if self.remote_conn is None:
+            return
+        if self.remote_input is not None:
+            self.remote_input.close()
+            self.remote_input = None
+        if self.remote_output is not None:
+            self.remote_output.close()
+            self.remote_output = None
+        close_nothrow(self.remote_conn)
+        self.remote_conn = None
+        self.remote_addr = None
+        self.remote_reusable = False
+
+    def release_remote(self):
+        """ Give the remote connection back to upstream_pool if it can be kept alive, close it otherwise. """
+        if self.remote_conn is None:
+            return
+        if not self.remote_reusable or self.remote_addr is None or self.remote_input.buffered() or \
+                self.remote_conn in [sent for r, sent, parent in self.pipelined]:
+            # Not at a message boundary, or requests sent ahead are outstanding
+            self.close_remote()
+            return
+        upstream_pool.release(self.remote_addr, self.remote_conn)
+        self.remote_input.release()
+        self.remote_conn = None
+        self.remote_input = None
+        self.remote_output = None
+        self.remote_addr = None
+        self.remote_reusable = False
+
+    def final_clean(self):
+        if not self.cleaned:
+            self.cleaned = True
+            metrics.connection(False)
+        if not self.detached:
+            self.client_input.close()
+            self.client_output.close()
+            close_nothrow(self.client_conn)
+        else:
+            self.client_input.release()
+        self.release_remote()
+        while len(self.pipelined):
+            r, sent, parent = self.pipelined.popleft()
+            if parent is not None:
+                parents.release(parent)
+
+    def handle_request(self, request):
+        method = request.method()
+        if method == "CONNECT":
+            return self.handle_CONNECT(request)
+        elif method not in ["GET", "HEAD", "POST", "PUT", "DELETE", "TRACE", "OPTIONS"]:
+            raise IOException("Unknown method: " + method)
+
+        original_url = request.target()
         if method == "GET":
             hit(original_url)
 
-        urlparts = urlparse.urlparse(original_url)
+        host, port, fwd = self.forward_request(request)
+        verdict = {} if rule_file is None else rule_file.match(host, original_url)
+        if verdict.get("access") == "block":
+            return self.refuse(request)
+        self.cacheable = verdict.get("cache") != "bypass"
+        self.route(fwd, request, verdict)
+        if self.sent_ahead is not None:
+            # Already sent while an earlier response was read, the cache has been checked then
+            return self.forward_response(original_url, request, fwd, host, port, None, False, None)
+
+        entry = None
+        validating = False
+        if response_cache is not None and method == "GET" and self.cacheable:
+            now = time.time()
+            entry = response_cache.lookup(original_url, request)
+            if entry is not None and response_cache.usable(entry, request, now):
+                return self.serve_cached(entry, request, now)
+            if entry is not None and not request.has("If-None-Match") and not request.has("If-Modified-Since"):
+                # Stale, revalidate the stored response
+                if entry.etag is not None:
+                    fwd.add("If-None-Match", entry.etag)
+                    validating = True
+                if entry.last_modified is not None:
+                    fwd.add("If-Modified-Since", entry.last_modified)
+                    validating = True
+
+        flight = None
+        if collapser is not None and self.cacheable and not validating and collapser.collapsible(request):
+            flight, reader = collapser.attach(original_url, request)
+            if reader is not None and self.follow(request, reader):
+                return
+        complete = False
+        try:
+            complete = self.forward_response(original_url, request, fwd, host, port, entry, validating, flight)
+        finally:
+            if flight is not None:
+                collapser.finish(flight, complete)
+
+    def refuse(self, request):
+        """ Answer a request blocked by the rules. """
+        self.status = 403
+        if request.body_pending:
+            # The body isn't read, the connection can't be used for another request
+            self.keep_alive = False
+        body = "Blocked by the proxy rules.\n"
+        self.client_output.write("HTTP/1.1 403 Forbidden\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n%s\r\n%s"
+                                 % (len(body), "" if self.keep_alive else "Connection: close\r\n", body))
+
+    def route(self, fwd, request, verdict):
+        """ Send fwd through a parent proxy, if there are parents and the rules don't say direct. """
+        if parents is not None and verdict.get("route") != "direct":
+            fwd.proxied = True
+            fwd.set_request(request.target(), request.method())
+
+    def use_parent(self, parent):
+        """ Make parent the one the current request is outstanding at, None for none. """
+        if self.parent is not None:
+            parents.release(self.parent)
+        self.parent = parent
+
+    def forward_request(self, request):
+        """ Make the request to send to the origin server for a client request.
+        :return: A tuple (host, port, request)
+        """
+        urlparts = urlparse.urlparse(request.target())
         host = urlparts.netloc
         port = 80
         if ':' in urlparts.netloc:
@@ -554,32 +3944,175 @@ class HttpProxyHandler:
         if len(urlparts.query):
             target += "?" + urlparts.query
         fwd = HttpRequest()
-        fwd.set_request(target, method)
+        fwd.set_request(target, request.method())
 
         # Add Host field if needed
         if not request.has("Host"):
             fwd.add("Host", urlparts.netloc)
 
-        for i in range(0, len(request.headers)):
-            if request.headers.keys[i].lower().startswith("proxy-"):
+        for key, value in request.headers:
+            if key[:6].lower() == "proxy-":
                 # No forward proxy specific headers
                 continue
-            fwd.add_header(request.headers.at(i))
+            fwd.add(key, value)
 
         fwd.body = request.body
         fwd.body_pending = request.body_pending
+        return host, port, fwd
+
+    def forward_response(self, url, request, fwd, host, port, entry, validating, flight):
+        """ Fetch the response to fwd and forward it to the client, and to the followers of
+        flight if there is one.
+        :return: True if the whole response has been received
+        """
+        resp = self.fetch(host, port, fwd)
+        self.status = resp.code()
+
+        if validating and self.status == 304:
+            self.remote_reusable = not resp.body_pending and message_keep_alive(resp)
+            now = time.time()
+            self.serve_cached(response_cache.refresh(entry, resp, now), request, now)
+            return True
+
+        # forward the response to proxy client, the cache and the followers of flight get
+        # it as received
+        gzip = self.start_response(request, resp)
+        output = self.client_output if gzip is None else gzip
+        if flight is not None and flight.publish(request, resp):
+            output = FlightOutputStream(output, flight)
+
+        if response_cache is None or request.method() != "GET" or not self.cacheable or \
+                not response_cache.storable(request, resp):
+            complete = True
+            if resp.body_pending:
+                start = time.time()
+                complete = forward_message_body(output, resp, self.remote_input)
+                metrics.record("body", time.time() - start)
+            self.remote_reusable = complete and message_keep_alive(resp)
+            self.check_lost(output)
+            if gzip is not None:
+                gzip.finish()
+            return complete
+        tee = response_cache.tee(output, resp)
+        try:
+            complete = True
+            if resp.body_pending:
+                start = time.time()
+                complete = forward_message_body(tee, resp, self.remote_input)
+                metrics.record("body", time.time() - start)
+            self.remote_reusable = complete and message_keep_alive(resp)
+            if complete:
+                response_cache.finish(tee, url, request, resp, time.time())
+        finally:
+            # Drop a partial copy, a disk fill must give its segment back
+            tee.abort()
+        self.check_lost(output)
+        if gzip is not None:
+            gzip.finish()
+        return complete
+
+    def start_response(self, request, resp):
+        """ Write the header part of resp to the client, and its body if resp holds it. The
+        body is compressed if the compressor takes it.
+        :return: The GzipOutputStream the rest of the body is to be written to, which is to
+         be finished, None if the body is sent as it is
+        """
+        if body_until_close(resp):
+            # The client learns where the body ends from the end of the connection too
+            self.keep_alive = False
+        gzip = None
+        if compressor is not None:
+            gzip = compressor.encoder(request, resp, self.client_output)
+        if gzip is None:
+            self.client_output.writev(resp.buffers())
+            return None
+        self.client_output.writev(gzip.head.buffers())
+        if not resp.body_pending and len(resp.body):
+            gzip.write(resp.body)
+        return gzip
+
+    def check_lost(self, output):
+        if isinstance(output, FlightOutputStream) and output.lost is not None:
+            raise IOException("Client lost while relaying a collapsed response: " + str(output.lost))
+
+    def follow(self, request, reader):
+        """ Answer a request with the response fetched for an identical one.
+        :return: False if the response can't be shared and the request must be sent on its own
+        """
+        resp = reader.head()
+        if resp is None:
+            collapser.fallback()
+            return False
+        self.status = resp.code()
+        try:
+            gzip = self.start_response(request, resp)
+            output = self.client_output if gzip is None else gzip
+            if resp.body_pending:
+                data = reader.next()
+                while len(data):
+                    output.write(data)
+                    data = reader.next()
+            if gzip is not None:
+                gzip.finish()
+        finally:
+            reader.flight.leave(reader)
+        return True
+
+    def fetch(self, host, port, fwd):
+        """ Send a request to host:port and read the response header. """
+        data = fwd.buffers()
+        if self.sent_ahead is not None and self.sent_ahead is self.remote_conn and self.remote_reusable:
+            # Sent over the connection while an earlier response was read
+            self.remote_reused = True
+            self.remote_reusable = False
+        else:
+            self.send_with_retry(host, port, data, proxied=fwd.proxied)
+            if fwd.body_pending:
+                forward_message_body(self.remote_output, fwd, self.client_input)
+        sent = time.time()
+        if self.keep_alive and fwd.method() in HttpProxyHandler.SAFE_METHODS and not fwd.body_pending:
+            self.read_ahead(host, port)
 
-        # forward the request to remote server
-        self.send_with_retry(host, port, str(fwd))
-        if method == "POST" and fwd.body_pending:
-            # Only POST messages may carry a message body
-            forward_message_body(self.remote_output, fwd, self.client_input)
+        try:
+            resp = self.remote_input.read_response(fwd.method())
+            metrics.record("ttfb", time.time() - sent)
+            if self.parent is not None:
+                parents.succeeded(self.parent)
+            return resp
+        except IOException:
+            if not self.remote_reused or fwd.body_pending:
+                raise
+            # The pooled connection was closed by the server right after it was checked, as
+            # nothing has been received yet it's safe to send the request again.
+            self.close_remote()
+            self.send_with_retry(host, port, data, pooled=False, proxied=fwd.proxied)
+            resp = self.remote_input.read_response(fwd.method())
+            metrics.record("ttfb", time.time() - sent)
+            if self.parent is not None:
+                parents.succeeded(self.parent)
+            return resp
 
-        # forward the response to proxy client
-        resp = self.remote_input.read_response()
-        self.client_output.write(str(resp))
-        if resp.body_pending:
-            forward_message_body(self.client_output, resp, self.remote_input)
+    def serve_cached(self, entry, request, now):
+        resp = entry.response(now)
+        self.status = resp.code()
+        etag = request.get("If-None-Match")
+        if etag is not None and entry.etag is not None and entry.etag in [t.strip(" \t") for t in etag.split(",")]:
+            # The client has it already
+            resp.set_status("304", "Not Modified", entry.start_line.split(" ", 1)[0])
+            self.status = 304
+            resp.headers.delete("Content-Length")
+            resp.headers.delete("Transfer-Encoding")
+            resp.body = ""
+            self.client_output.writev(resp.buffers())
+        elif isinstance(entry, DiskEntry):
+            # Sent by sendfile as stored, not compressed
+            self.client_output.writev(resp.buffers())
+            response_cache.disk.send(entry, self.client_output)
+        else:
+            gzip = self.start_response(request, resp)
+            if gzip is not None:
+                gzip.finish()
+        response_cache.served(entry)
 
     def handle_CONNECT(self, request):
         a = request.start_line.find(' ')
@@ -589,87 +4122,1064 @@ class HttpProxyHandler:
         port = int(request.start_line[c+1:b].strip(" \t"))
         if not len(host) or port <= 0:
             raise IOException("Bad CONNECT request target")
+        verdict = {} if rule_file is None else rule_file.match(host)
+        if verdict.get("access") == "block":
+            self.keep_alive = False
+            return self.refuse(request)
 
         paddr, pport = self.client_conn.getpeername()
         log("%s:%d <--> %s:%d" % (paddr, pport, host, port))
+        start = time.time()
 
+        answer, early = None, ""
         try:
-            if self.remote_addr != (host, port):
-                self.close_remote()
-                self.remote_conn = socket.create_connection((host, port))
+            # A tunnel never goes back to the pool, always use a fresh connection
+            self.release_remote()
+            if parents is not None and verdict.get("route") != "direct":
+                self.remote_conn, answer, early = self.tunnel_parent(host, port)
+            else:
+                self.remote_conn = resolver.connect(host, port, timeouts.connect)
         except Exception:
+            self.status = 503
             self.client_output.write("HTTP/1.1 503 Service Unavailable\r\nHost: seal\r\n\r\n")
             raise IOException("Failed to create tunnel %s:%d" % (host, port))
+        if answer is not None and not 200 <= answer.code() < 300:
+            # Refused by the parent, its status tells the client why
+            self.status = answer.code()
+            self.keep_alive = False
+            self.client_output.write(answer.start_line + "\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            return
 
+        self.status = 200
         self.client_output.write("HTTP/1.1 200 OK\r\nHost: seal\r\n\r\n")
-        fwd = SocketTunnel((self.client_conn, self.remote_conn))
+        if early:
+            # Sent by the target through the parent right after the tunnel was set up
+            self.client_output.write(early)
+        if self.client_input.buffered():
+            # Data sent by client right after the CONNECT request
+            self.remote_conn.sendall(self.client_input.read_some(self.client_input.buffered()))
+        if tunnel_reactor is not None:
+            tunnel_reactor.add((self.client_conn, self.remote_conn), self.client_output.client)
+            metrics.record("tunnel_setup", time.time() - start)
+            self.detached = True
+            self.remote_conn = None
+            return
+        metrics.record("tunnel_setup", time.time() - start)
+        fwd = SocketTunnel((self.client_conn, self.remote_conn), self.client_output.client)
         fwd.run()
 
-    def send_with_retry(self, host, port, data, retries=3):
-        # HTTP is a stateless protocol, thus we could reuse the connection
+    def tunnel_parent(self, host, port, retries=3):
+        """ Open a tunnel to host:port through a parent proxy, another one is chosen for each try.
+        :return: A tuple (connection, response of the parent, data received after the response)
+        """
+        target = "%s:%d" % (host, port)
+        request = "CONNECT %s HTTP/1.1\r\nHost: %s\r\n\r\n" % (target, target)
+        for i in range(0, retries):
+            self.use_parent(parents.pick())
+            conn = upstream_pool.acquire(self.parent.addr)
+            fresh = conn is None
+            try:
+                if fresh:
+                    conn = resolver.connect(self.parent.addr[0], self.parent.addr[1], timeouts.connect)
+                    conn.settimeout(timeouts.body)
+                HttpOutputStream(conn).write(request)
+                stream = HttpInputStream(conn)
+                try:
+                    # An answer that opens the tunnel has no body, the body of a refusal isn't relayed
+                    resp = stream.read_response("HEAD")
+                    early = stream.read(stream.buffered())
+                finally:
+                    stream.release()
+            except (IOException, socket.error):
+                close_nothrow(conn)
+                if fresh:
+                    parents.failed(self.parent)
+                continue
+            parents.succeeded(self.parent)
+            return conn, resp, early
+        raise IOException("No parent proxy to tunnel %s through" % target)
+
+    def send_with_retry(self, host, port, data, retries=3, pooled=True, proxied=False):
+        """ Send a message to host:port.
+        :param data: The message as a list of buffers, see HttpMessage.buffers
+        :param proxied: Send it to a parent proxy instead, another one is chosen for each try
+        """
+        # HTTP is a stateless protocol, thus we could reuse the connection, either the one
+        # kept by this handler or an idle one from upstream_pool.
         # However, since the kept old connection may have been closed by remote server, we
         # have to do some retry
+        if not self.remote_reusable:
+            # The previous exchange didn't end at a message boundary
+            self.close_remote()
         retry_count = 0
         while retry_count < retries:
+            addr = (host, port)
+            if proxied:
+                self.use_parent(parents.pick())
+                addr = self.parent.addr
             try:
-                if self.remote_addr != (host, port):
-                    self.close_remote()
+                if self.remote_addr == addr:
+                    # kept alive since the previous request
+                    self.remote_reused = True
+                else:
+                    self.release_remote()
                     # connect to the new remote server
-                    self.remote_addr = (host, port)
-                    self.remote_conn = socket.create_connection((host, port))
-                    self.remote_input = HttpInputStream(self.remote_conn)
+                    conn = None
+                    if pooled:
+                        conn = upstream_pool.acquire(addr)
+                    self.remote_reused = conn is not None
+                    if conn is None:
+                        conn = resolver.connect(addr[0], addr[1], timeouts.connect)
+                        conn.settimeout(timeouts.body)
+                    self.remote_addr = addr
+                    self.remote_conn = conn
+                    self.remote_input = HttpInputStream(self.remote_conn, max_header=HttpProxyHandler.MAX_HEADER)
                     self.remote_output = HttpOutputStream(self.remote_conn)
-                self.remote_output.write(data)
+                self.remote_reusable = False
+                self.remote_output.writev(data)
                 break
             except (IOException, Exception):
                 # connection seems broken
+                if proxied and not self.remote_reused:
+                    parents.failed(self.parent)
                 self.close_remote()
                 retry_count += 1
         if retry_count >= retries:
-            log("Couldn't connect %d:%d" % (host, port))
+            log("Couldn't connect %s:%d" % (host, port))
             raise IOException("Can't connect to remote server: %s:%d" % (host, port))
 
 
+# SO_REUSEPORT lets the worker processes bind the same port, Linux 3.9+
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15 if sys.platform.startswith("linux") else None)
+
+
+def listen_socket(address, backlog, reuse_port=False):
+    s = socket.socket()
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        s.bind(address)
+        s.listen(backlog)
+    except Exception:
+        s.close()
+        raise
+    return s
+
+
 class ThreadingServer:
-    def __init__(self, address, handler):
+    """ Serves each client connection in a thread of a pool of at most threads, for as long
+    as the connection lasts. Accepted connections wait for a free thread in a queue of at
+    most queue_size. When the queue is full, saturation tells what happens to a new one:
+    "wait" stops accepting until there is room and leaves the rest in the listen backlog,
+    "503" answers 503 Service Unavailable and closes it, "close" closes it right away.
+    While connections are queued, a thread gives up its connection when it's idle between
+    requests rather than wait for the next one, it looks at the queue every IDLE_CHECK seconds.
+    """
+    SATURATION = ("wait", "503", "close")
+    IDLE_CHECK = 1.0
+    BUSY_RESPONSE = "HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\n" \
+                    "Connection: close\r\n\r\n"
+
+    def __init__(self, address, handler, threads=256, queue_size=256, saturation="wait"):
         self.address = address
         self.backlog = 50
         self.handler = handler
+        self.threads = threads
+        self.saturation = saturation
+        self.jobs = Queue.Queue(max(queue_size, 1))     # (connection, time accepted) waiting for a thread
+        self.lock = threading.Lock()
+        self.started = 0            # threads in the pool
+        self.idle = 0               # threads waiting for a connection
+        self.accepted = 0
+        self.rejected = 0
+        self.shed = 0               # idle connections given up for queued ones
+        self.queue_peak = 0
+        self.listener = None        # a listening socket to serve instead of binding address
+        self.reuse_port = False     # bind address with SO_REUSEPORT
 
     def run(self):
-        s = None
+        s = self.listener
         try:
-            s = socket.socket()
-            s.bind(self.address)
-            s.listen(self.backlog)
-            log("Starting proxy service at %s:%d" % self.address)
+            if s is None:
+                s = listen_socket(self.address, self.backlog, self.reuse_port)
+            log("Starting proxy service at %s:%d (%d threads)" % (self.address + (self.threads,)))
             while True:
-                handler = self.handler(s.accept()[0])
-                threading.Thread(target=handler.run).start()
+                self._admit(s.accept()[0])
         except Exception:
             error("Caught an unhandled exception, exit service loop...")
         finally:
-            s.close()
+            if s is not self.listener:
+                # An inherited listener serves the next run after a restart
+                close_nothrow(s)
+            self._shutdown()
 
+    def stats(self):
+        with self.lock:
+            return {
+                "threads": self.started,
+                "busy": self.started - self.idle,
+                "queued": self.jobs.qsize(),
+                "queue_peak": self.queue_peak,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "shed": self.shed,
+            }
 
-def main():
-    addr = "0.0.0.0"
-    port = 8085
-    restart_time = 3
-    restart_time_upper_bound = 30
+    def _admit(self, conn):
+        item = (conn, time.time())
+        if self.saturation == "wait":
+            self._grow(self.jobs.qsize() + 1)
+            self.jobs.put(item)
+        else:
+            try:
+                self.jobs.put_nowait(item)
+            except Queue.Full:
+                self._reject(conn)
+                return
+        queued = self.jobs.qsize()
+        with self.lock:
+            self.accepted += 1
+            self.queue_peak = max(self.queue_peak, queued)
+        self._grow(queued)
+
+    def _grow(self, queued):
+        """ Start one more thread if there are fewer idle threads than queued connections. """
+        with self.lock:
+            if self.started >= self.threads or self.idle >= queued:
+                return
+            self.started += 1
+        t = threading.Thread(target=self._work)
+        t.daemon = True
+        t.start()
+
+    def _reject(self, conn):
+        with self.lock:
+            self.rejected += 1
+        try:
+            conn.setblocking(0)
+            if self.saturation == "503":
+                try:
+                    # Closing with the request unread would reset the connection, the 503 may be lost
+                    conn.recv(65536)
+                except socket.error:
+                    pass
+                conn.send(ThreadingServer.BUSY_RESPONSE)
+        except socket.error:
+            pass
+        close_nothrow(conn)
+
+    def _work(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            item = self.jobs.get()
+            with self.lock:
+                self.idle -= 1
+                if item is None:
+                    self.started -= 1
+                    return
+            conn, accepted = item
+            metrics.record("queue_wait", time.time() - accepted)
+            try:
+                handler = self.handler(conn)
+            except Exception:
+                close_nothrow(conn)
+                continue
+            handler.wait_idle = False
+            while True:
+                if not handler.pending() and not self._wait_request(handler):
+                    handler.final_clean()
+                    break
+                if not handler.step():
+                    break
+
+    def _wait_request(self, handler):
+        """ Wait for the client to send its next request, within the keep-alive timeout. The
+        read buffer of an idle client goes back to buffer_pool meanwhile.
+        :return: False if the connection is to be given up, for timing out or for queued ones
+        """
+        conn = handler.client_conn
+        if wait_readable(conn, 0):
+            return True
+        handler.client_input.release(idle=True)
+        limit = timeouts.keep_alive
+        start = time.time()
+        while True:
+            wait = ThreadingServer.IDLE_CHECK
+            if limit is not None:
+                wait = min(wait, start + limit - time.time())
+            if wait_readable(conn, wait):
+                return True
+            if not self.jobs.empty():
+                with self.lock:
+                    self.shed += 1
+                return False
+            if limit is not None and time.time() - start >= limit:
+                timeouts.expired("keep_alive")
+                return False
+
+    def _shutdown(self):
+        while True:
+            try:
+                item = self.jobs.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not None:
+                close_nothrow(item[0])
+        with self.lock:
+            started = self.started
+        for i in range(0, started):
+            try:
+                self.jobs.put_nowait(None)
+            except Queue.Full:
+                break
+
+
+class EventLoopServer:
+    """ A drop-in alternative to ThreadingServer.
+    Idle keep-alive client connections are parked in an epoll set instead of
+    holding a blocked thread each. A connection is handed to a fixed pool of worker
+    threads only when it becomes readable, the worker serves one request with the very
+    same HttpProxyHandler logic and then parks the connection again. Connections parked
+    for longer than the keep-alive timeout are closed. As they all wait for the same time,
+    the order they were parked in is the order they expire in, a FIFO is their timer queue.
+    """
+    def __init__(self, address, handler, workers=32):
+        self.address = address
+        self.backlog = 1024
+        self.handler = handler
+        self.workers = workers
+        self.poller = None
+        self.parked = {}                        # fd -> handler of every client connection no worker has
+        self.busy = 0                           # client connections taken out of parked for a worker
+        self.idle = collections.OrderedDict()   # fd -> time it was parked waiting for a request, oldest first
+        self.idle_lock = threading.Lock()
+        self.next_reap = 0
+        self.jobs = Queue.Queue()               # (handler, time it became ready) ready to serve a request
+        self.listener = None                    # a listening socket to serve instead of binding address
+        self.reuse_port = False                 # bind address with SO_REUSEPORT
+
+    def run(self):
+        s = self.listener
+        try:
+            if s is None:
+                s = listen_socket(self.address, self.backlog, self.reuse_port)
+            s.setblocking(0)
+            self.poller = _Poller()
+            self.poller.register(s.fileno(), oneshot=False)
+            for i in range(0, self.workers):
+                t = threading.Thread(target=self._work)
+                t.daemon = True
+                t.start()
+            log("Starting proxy service at %s:%d (epoll, %d workers)" % (self.address + (self.workers,)))
+            while True:
+                for fd in self.poller.poll(1.0 if timeouts.keep_alive is not None else -1):
+                    if fd == s.fileno():
+                        self._accept(s)
+                    else:
+                        # A worker puts the handler back if the connection is kept alive, so
+                        # that a closed fd never has an entry, the number may be reused at once
+                        handler = self.parked.pop(fd, None)
+                        self._unpark(fd)
+                        if handler is None:
+                            continue
+                        with self.idle_lock:
+                            self.busy += 1
+                        self.jobs.put((handler, time.time()))
+                self._reap(time.time())
+        except Exception:
+            error("Caught an unhandled exception, exit service loop...")
+        finally:
+            if s is not self.listener:
+                # An inherited listener serves the next run after a restart
+                close_nothrow(s)
+            self._shutdown()
+
+    def _accept(self, s):
+        while True:
+            try:
+                conn = s.accept()[0]
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                    warn("Too many open files, accept postponed.")
+                    return
+                raise
+            conn.setblocking(1)
+            fd = conn.fileno()
+            handler = self.handler(conn)
+            handler.wait_idle = False
+            self.parked[fd] = handler
+            self._park(fd)
+            self.poller.register(fd)
+
+    def stats(self):
+        return {"workers": self.workers, "connections": len(self.parked) + self.busy, "idle": len(self.idle),
+                "queued": self.jobs.qsize()}
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            handler, ready = job
+            metrics.record("queue_wait", time.time() - ready)
+            fd = handler.client_conn.fileno()
+            if not handler.step():
+                with self.idle_lock:
+                    self.busy -= 1
+            elif handler.pending():
+                # Pipelined request already buffered, no need to wait for the socket.
+                self.jobs.put((handler, time.time()))
+            else:
+                # Parked before it's armed, the event loop may take it right away. Its read
+                # buffer isn't needed until the next request
+                handler.client_input.release(idle=True)
+                self.parked[fd] = handler
+                with self.idle_lock:
+                    self.busy -= 1
+                self._park(fd)
+                self.poller.rearm(fd)
+
+    def _park(self, fd):
+        with self.idle_lock:
+            self.idle[fd] = time.time()
+
+    def _unpark(self, fd):
+        with self.idle_lock:
+            self.idle.pop(fd, None)
+
+    def _reap(self, now):
+        """ Close the connections that have waited for a request for longer than the keep-alive
+        timeout. Runs at most once per second, only the expired connections are visited. """
+        limit = timeouts.keep_alive
+        if limit is None or now < self.next_reap:
+            return
+        self.next_reap = now + 1.0
+        expired = []
+        with self.idle_lock:
+            while len(self.idle):
+                fd, since = next(self.idle.iteritems())
+                if now - since < limit:
+                    break
+                del self.idle[fd]
+                expired.append(fd)
+        for fd in expired:
+            # Armed and not reported, no worker has it
+            handler = self.parked.pop(fd, None)
+            if handler is not None:
+                timeouts.expired("keep_alive")
+                handler.final_clean()
+
+    def _shutdown(self):
+        for i in range(0, self.workers):
+            self.jobs.put(None)
+        if self.poller is not None:
+            self.poller.close()
+            self.poller = None
+        for handler in self.parked.values():
+            handler.final_clean()
+        self.parked = {}
+        self.idle.clear()
+
+
+class _Poller:
+    """ One-shot epoll wrapper: a connection is reported once until it is re-armed, so a
+    connection being served by a worker doesn't wake up the event loop again.
+    """
+    def __init__(self):
+        self.impl = select.epoll()
+
+    def register(self, fd, oneshot=True):
+        mask = select.EPOLLIN
+        if oneshot:
+            mask |= select.EPOLLONESHOT
+        self.impl.register(fd, mask)
+
+    def rearm(self, fd):
+        self.impl.modify(fd, select.EPOLLIN | select.EPOLLONESHOT)
+
+    def poll(self, timeout=-1):
+        try:
+            return [fd for fd, ev in self.impl.poll(timeout)]
+        except IOError, e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        self.impl.close()
+
+
+# The server of the running proxy service, for its counters
+proxy_server = None
+
+
+def collect_stats():
+    """ Gather the counters of all subsystems.
+    :return: A dict of subsystem name -> dict of counter name -> value
+    """
+    stats = {"pool": upstream_pool.stats()}
+    if parents is not None:
+        stats["parents"] = parents.stats()
+    if proxy_server is not None:
+        stats["server"] = proxy_server.stats()
+    if tunnel_reactor is not None:
+        stats["tunnels"] = tunnel_reactor.stats()
+    if response_cache is not None:
+        stats["cache"] = response_cache.stats()
+        if response_cache.disk is not None:
+            stats["disk"] = response_cache.disk.stats()
+    stats["dns"] = resolver.stats()
+    if log_writer is not None:
+        stats["log"] = log_writer.stats()
+    if access_log is not None:
+        stats["access_log"] = access_log.stats()
+    if collapser is not None:
+        stats["collapse"] = collapser.stats()
+    stats["buffers"] = buffer_pool.stats()
+    stats["handlers"] = metrics.stats()
+    stats["timeouts"] = timeouts.stats()
+    if shaper is not None:
+        stats["shaping"] = shaper.stats()
+    if compressor is not None:
+        stats["compression"] = compressor.stats()
+        stats["compression_types"] = compressor.type_stats()
+    if rule_file is not None:
+        stats["rules"] = rule_file.stats()
+        stats["rule_hits"] = rule_file.hits()
+    stats["stages"] = metrics.stage_stats()
+    return stats
+
+
+def _stat_text(value):
+    if not isinstance(value, list):
+        return str(value)
+    # A histogram snapshot: count/p50/p99 in ms
+    return "%d/%.1f/%.1fms" % (Histogram.count(value), Histogram.percentile(value, 0.5) * 1000,
+                               Histogram.percentile(value, 0.99) * 1000)
+
+
+def log_stats(stats):
+    for name, counters in sorted(stats.items()):
+        log("%s: %s" % (name, " ".join(["%s=%s" % (k, _stat_text(v)) for k, v in sorted(counters.items())])))
+
+
+def report_stats(interval):
+    """ Log the counters of all subsystems every interval seconds. """
+    while True:
+        time.sleep(interval)
+        log_stats(collect_stats())
+
+
+def push_stats(fd, interval):
+    """ Send the counters of all subsystems to the supervisor every interval seconds, as a
+    line of JSON written to fd. """
+    while True:
+        time.sleep(interval)
+        try:
+            os.write(fd, json.dumps(collect_stats()) + "\n")
+        except OSError:
+            return
+
+
+def merge_stats(stats):
+    """ Add up the counters of several processes.
+    :param stats: A list of dicts as returned by collect_stats
+    """
+    total = {}
+    for s in stats:
+        for name, counters in s.items():
+            merged = total.setdefault(name, {})
+            for k, v in counters.items():
+                if isinstance(v, list):
+                    # Histogram snapshots
+                    acc = merged.setdefault(k, [])
+                    acc.extend([0] * (len(v) - len(acc)))
+                    for i, n in enumerate(v):
+                        acc[i] += n
+                elif isinstance(v, (int, long, float)) and not isinstance(v, bool):
+                    merged[k] = merged.get(k, 0) + v
+    return total
+
+
+# Bucket bounds of the stage histograms exposed to Prometheus, in seconds
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def format_metrics(stats):
+    """ Render counters in the Prometheus text exposition format.
+    :param stats: A dict as returned by collect_stats
+    """
+    lines = []
+    for name, counters in sorted(stats.items()):
+        if name in ("stages", "rule_hits", "compression_types"):
+            continue
+        for k, v in sorted(counters.items()):
+            if isinstance(v, (int, long, float)) and not isinstance(v, bool):
+                lines.append("seal_%s_%s %s" % (name, k, repr(v)))
+    hits = sorted(stats.get("rule_hits", {}).items())
+    if hits:
+        lines.append("# TYPE seal_rule_hits counter")
+    for rule, count in hits:
+        label = rule.replace("\\", "\\\\").replace('"', '\\"')
+        lines.append('seal_rule_hits{rule="%s"} %d' % (label, count))
+    types = sorted(stats.get("compression_types", {}).items())
+    for key, value in types:
+        ctype, counter = key.rsplit(":", 1)
+        label = ctype.replace("\\", "\\\\").replace('"', '\\"')
+        lines.append('seal_compression_type_%s{type="%s"} %s' % (counter, label, repr(value)))
+    stages = sorted(stats.get("stages", {}).items())
+    lines.append("# HELP seal_stage_seconds Duration of the stages of serving requests.")
+    lines.append("# TYPE seal_stage_seconds histogram")
+    for stage, snapshot in stages:
+        for le in METRICS_BUCKETS:
+            lines.append('seal_stage_seconds_bucket{stage="%s",le="%s"} %d'
+                         % (stage, repr(le), Histogram.below(snapshot, le)))
+        count = Histogram.count(snapshot)
+        lines.append('seal_stage_seconds_bucket{stage="%s",le="+Inf"} %d' % (stage, count))
+        lines.append('seal_stage_seconds_sum{stage="%s"} %s' % (stage, repr(snapshot[0])))
+        lines.append('seal_stage_seconds_count{stage="%s"} %d' % (stage, count))
+    lines.append("# TYPE seal_stage_quantile_seconds gauge")
+    for stage, snapshot in stages:
+        for q in METRICS_QUANTILES:
+            lines.append('seal_stage_quantile_seconds{stage="%s",quantile="%s"} %s'
+                         % (stage, repr(q), repr(Histogram.percentile(snapshot, q))))
+    return "\n".join(lines) + "\n"
+
+
+class AdminServer:
+    """ Answers GET /metrics with the counters in the Prometheus text format and GET /stats
+    with them as JSON, one request at a time in a background thread. It's meant to listen
+    on a local address only.
+    """
+    TIMEOUT = 5.0
+
+    def __init__(self, address, collect):
+        """ :param collect: A function returning the counters, see collect_stats """
+        self.address = address
+        self.collect = collect
+        self.listener = listen_socket(address, 16)
+
+    def start(self):
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+        log("Serving metrics at http://%s:%d/metrics" % self.address)
+
+    def _run(self):
+        while True:
+            try:
+                conn = self.listener.accept()[0]
+            except socket.error:
+                continue
+            try:
+                conn.settimeout(AdminServer.TIMEOUT)
+                self._answer(conn)
+            except (IOException, socket.error):
+                pass
+            except Exception:
+                error("Failed to answer an admin request.")
+            finally:
+                close_nothrow(conn)
+
+    def _answer(self, conn):
+        stream = HttpInputStream(conn)
+        try:
+            request = stream.read_request()
+        finally:
+            stream.release()
+        path = request.target().split("?", 1)[0]
+        if request.method() != "GET":
+            status, ctype, body = "405 Method Not Allowed", "text/plain", "GET only\n"
+        elif path == "/metrics":
+            status, ctype, body = "200 OK", "text/plain; version=0.0.4", format_metrics(self.collect())
+        elif path == "/stats":
+            status, ctype, body = "200 OK", "application/json", json.dumps(self.collect(), sort_keys=True) + "\n"
+        else:
+            status, ctype, body = "404 Not Found", "text/plain", "Try /metrics or /stats\n"
+        HttpOutputStream(conn).write("HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n"
+                                     "Connection: close\r\n\r\n%s" % (status, ctype, len(body), body))
+
+
+class Backoff:
+    """ Delays between restarts of a failing service, growing until it's given up. """
+    def __init__(self, start=3, step=3, upper_bound=30):
+        self.start = start
+        self.step = step
+        self.upper_bound = upper_bound
+        self.reset()
+
+    def reset(self):
+        self.current = self.start
+
+    def next(self):
+        """ Get the seconds to wait before the next restart, None if it's time to give up. """
+        if self.current > self.upper_bound:
+            return None
+        delay = self.current
+        self.current += self.step
+        return delay
+
+
+class _Worker:
+    def __init__(self, slot):
+        self.slot = slot
+        self.pid = None
+        self.started = 0
+        self.stats_fd = None        # read end of the stats pipe
+        self.partial = ""
+        self.stats = {}             # latest counters pushed by the process
+        self.backoff = Backoff()
+        self.restart_at = None      # when a crashed process is due to be started again
+
+
+class Supervisor:
+    """ Runs the proxy in several forked worker processes, so that it isn't bound to a single
+    core by the GIL. Each worker binds the port with SO_REUSEPORT, or serves a listening socket
+    inherited from the supervisor where that's not supported. A worker that exits is started
+    again after a delay growing with each crash, the counters of the workers are added up.
+    """
+    STABLE = 60         # seconds a worker must run for its restart delay to be reset
+
+    def __init__(self, opts, serve):
+        self.opts = opts
+        self.serve = serve
+        self.workers = [_Worker(i) for i in range(0, opts.processes)]
+        self.listener = None
+        self.admin = None
+        self.restarts = 0
+        self.stopping = False
+
+    def run(self):
+        if SO_REUSEPORT is None:
+            self.listener = listen_socket((self.opts.addr, self.opts.port), self.opts.backlog or 1024)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._stop())
+        if self.opts.admin_port > 0:
+            self.admin = AdminServer((self.opts.admin_addr, self.opts.admin_port), self.collect_stats)
+            self.admin.start()
+        log("Supervising %d worker processes at %s:%d" % (len(self.workers), self.opts.addr, self.opts.port))
+        for w in self.workers:
+            self._start(w)
+        last_report = time.time()
+        try:
+            while not self.stopping:
+                self._read_stats(1.0)
+                self._reap()
+                now = time.time()
+                for w in self.workers:
+                    if w.restart_at is not None and w.restart_at <= now:
+                        self._start(w)
+                if self.opts.stats_interval > 0 and now - last_report >= self.opts.stats_interval:
+                    last_report = now
+                    log_stats(self.collect_stats())
+        except KeyboardInterrupt:
+            pass
+        self._stop()
+        for w in self.workers:
+            if w.pid is not None:
+                os.waitpid(w.pid, 0)
+
+    def collect_stats(self):
+        stats = merge_stats([w.stats for w in self.workers])
+        stats["processes"] = {
+            "workers": len(self.workers),
+            "alive": len([w for w in self.workers if w.pid is not None]),
+            "restarts": self.restarts,
+        }
+        return stats
+
+    def _start(self, w):
+        w.restart_at = None
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Worker process
+            signal.signal(signal.SIGTERM, exit_on_signal)
+            os.close(rfd)
+            if self.admin is not None:
+                # The admin thread's frame, copied by fork, still references the socket,
+                # closing the object alone leaves the port bound by every worker
+                fd = self.admin.listener.fileno()
+                close_nothrow(self.admin.listener)
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            for other in self.workers:
+                if other.stats_fd is not None:
+                    os.close(other.stats_fd)
+            try:
+                self.serve(self.opts, w.slot, self.listener, wfd)
+            finally:
+                flush_log()
+                os._exit(1)
+        os.close(wfd)
+        w.pid = pid
+        w.started = time.time()
+        w.stats_fd = rfd
+        w.partial = ""
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if pid == 0:
+                return
+            for w in self.workers:
+                if w.pid != pid:
+                    continue
+                w.pid = None
+                if w.stats_fd is not None:
+                    os.close(w.stats_fd)
+                    w.stats_fd = None
+                w.stats = {}
+                if self.stopping:
+                    break
+                if time.time() - w.started > Supervisor.STABLE:
+                    w.backoff.reset()
+                delay = w.backoff.next()
+                if delay is None:
+                    error("Worker %d keeps failing, not restarting it." % w.slot)
+                    break
+                warn("Worker %d (pid %d) exited with status %d, restarting it after %d seconds."
+                     % (w.slot, pid, status, delay))
+                w.restart_at = time.time() + delay
+                self.restarts += 1
+
+    def _read_stats(self, timeout):
+        fds = [w.stats_fd for w in self.workers if w.stats_fd is not None]
+        if not fds:
+            time.sleep(timeout)
+            return
+        try:
+            readable = select.select(fds, [], [], timeout)[0]
+        except select.error:
+            return
+        for w in self.workers:
+            if w.stats_fd not in readable:
+                continue
+            try:
+                data = os.read(w.stats_fd, 65536)
+            except OSError:
+                continue
+            lines = (w.partial + data).split("\n")
+            w.partial = lines.pop()
+            for ln in lines:
+                try:
+                    w.stats = json.loads(ln)
+                except ValueError:
+                    pass
+
+    def _stop(self):
+        self.stopping = True
+        for w in self.workers:
+            if w.pid is not None:
+                try:
+                    os.kill(w.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+
+def raise_fd_limit():
+    """ Raise the soft limit of open files to the hard limit, an event loop engine is
+    expected to hold far more connections than the default 1024. """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="A transparent HTTP proxy server with tunnel support.")
+    parser.add_argument("--addr", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8085, help="port to listen on")
+    parser.add_argument("--engine", choices=["thread", "epoll"], default="thread",
+                        help="serving engine: a thread per connection, or an event loop with a worker pool")
+    parser.add_argument("--workers", type=int, default=32, help="worker threads of the epoll engine")
+    parser.add_argument("--threads", type=int, default=256, help="most connections served at once by the thread engine")
+    parser.add_argument("--accept-queue", type=int, default=256,
+                        help="connections the thread engine queues for a free thread")
+    parser.add_argument("--saturation", choices=ThreadingServer.SATURATION, default="wait",
+                        help="when the accept queue is full: stop accepting, answer 503, or close new connections")
+    parser.add_argument("--backlog", type=int, default=0,
+                        help="listen backlog, 0 for the engine default (thread: 50, epoll: 1024)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the port, each running the chosen engine")
+    parser.add_argument("--pool-per-host", type=int, default=8, help="idle upstream connections kept per host")
+    parser.add_argument("--pool-total", type=int, default=512, help="idle upstream connections kept in total")
+    parser.add_argument("--pool-idle", type=float, default=30.0, help="seconds an idle upstream connection is kept")
+    parser.add_argument("--buffer-pool", type=int, default=64,
+                        help="MB of idle I/O buffers kept for reuse by connections, 0 to allocate them afresh")
+    parser.add_argument("--no-splice", action="store_true", help="relay CONNECT tunnels by copying instead of splice(2)")
+    parser.add_argument("--tunnel-reactors", type=int, default=1,
+                        help="epoll threads serving CONNECT tunnels, 0 to relay each tunnel in its handler thread")
+    parser.add_argument("--tunnel-idle", type=float, default=300.0,
+                        help="seconds before an idle tunnel is closed, 0 for no limit")
+    parser.add_argument("--connect-timeout", type=float, default=30.0,
+                        help="seconds to connect to an origin, 0 for no limit")
+    parser.add_argument("--header-timeout", type=float, default=60.0,
+                        help="seconds a client may take to send a request header after its first bytes, 0 for no limit")
+    parser.add_argument("--body-timeout", type=float, default=300.0,
+                        help="seconds a transfer may stall, waiting for an origin to respond included, 0 for no limit")
+    parser.add_argument("--keep-alive-timeout", type=float, default=75.0,
+                        help="seconds a client connection may wait idle for its next request, 0 for no limit")
+    parser.add_argument("--dns-ttl", type=float, default=60.0, help="seconds a host name resolution is cached")
+    parser.add_argument("--dns-negative-ttl", type=float, default=5.0,
+                        help="seconds a failed host name resolution is cached")
+    parser.add_argument("--dns-hosts", metavar="FILE",
+                        help="resolve the names listed in a hosts file from there, the others as usual")
+    parser.add_argument("--cache-size", type=int, default=0, help="MB of memory for cached responses, 0 to disable")
+    parser.add_argument("--cache-object-max", type=int, default=0,
+                        help="KB of the largest response to cache, 1/16 of the cache size by default")
+    parser.add_argument("--disk-cache", metavar="DIR", help="directory of a disk cache tier for large responses")
+    parser.add_argument("--disk-cache-size", type=int, default=1024, help="MB of disk for cached responses")
+    parser.add_argument("--disk-segment", type=int, default=64, help="MB of a disk cache segment file")
+    parser.add_argument("--disk-object-max", type=int, default=0,
+                        help="MB of the largest response to cache on disk, a segment by default")
+    parser.add_argument("--collapse-window", type=float, default=0,
+                        help="seconds identical GET requests join a fetch in progress, 0 to disable")
+    parser.add_argument("--collapse-readers", type=int, default=64,
+                        help="requests answered by one collapsed fetch besides the first one")
+    parser.add_argument("--parent", metavar="HOST:PORT", type=parse_parent, action="append",
+                        help="parent proxy to forward requests and tunnels to, may be repeated")
+    parser.add_argument("--parent-failures", type=int, default=3,
+                        help="connect failures in a row that eject a parent proxy")
+    parser.add_argument("--parent-eject", type=float, default=30.0, help="seconds an ejected parent proxy is left out")
+    parser.add_argument("--client-rate", type=int, default=0,
+                        help="KB/s relayed to each client address, per worker process, 0 for no limit")
+    parser.add_argument("--total-rate", type=int, default=0, help="KB/s relayed to all clients, 0 for no limit")
+    parser.add_argument("--gzip", action="store_true",
+                        help="compress textual responses with gzip for the clients that accept it")
+    parser.add_argument("--gzip-level", type=int, choices=range(1, 10), default=6, help="highest gzip level")
+    parser.add_argument("--gzip-cpu", type=float, default=0.5,
+                        help="share of a core each process may spend compressing, the level is lowered beyond it")
+    parser.add_argument("--gzip-min", type=int, default=1024, help="bytes of the shortest body to compress")
+    parser.add_argument("--rules", metavar="FILE",
+                        help="file of block, allow and bypass rules for hosts and URLs, reloaded when it changes")
+    parser.add_argument("--rules-check", type=float, default=5.0, help="seconds between checks of the rule file")
+    parser.add_argument("--stats-interval", type=float, default=0, help="seconds between stats logs, 0 to disable")
+    parser.add_argument("--log-level", type=int, default=LOG_LEVEL, help="0: errors ... 3: everything")
+    parser.add_argument("--log-file", default="-", help="file to append the log to, - for stdout")
+    parser.add_argument("--access-log", metavar="FILE", help="file to append a line per request to, - for stdout")
+    parser.add_argument("--access-log-format", choices=["text", "json"], default="text",
+                        help="access log lines: time client method host status bytes seconds, or JSON objects")
+    parser.add_argument("--log-queue", type=int, default=65536,
+                        help="log lines waiting to be written before further lines are dropped")
+    parser.add_argument("--admin-port", type=int, default=0,
+                        help="port serving /metrics (Prometheus) and /stats (JSON), 0 to disable")
+    parser.add_argument("--admin-addr", default="127.0.0.1", help="address of the admin port")
+    return parser.parse_args(argv)
+
+
+def create_server(opts, listener=None):
+    if opts.engine == "epoll":
+        server = EventLoopServer((opts.addr, opts.port), HttpProxyHandler, opts.workers)
+    else:
+        server = ThreadingServer((opts.addr, opts.port), HttpProxyHandler, opts.threads, opts.accept_queue,
+                                 opts.saturation)
+    if opts.backlog > 0:
+        server.backlog = opts.backlog
+    server.listener = listener
+    server.reuse_port = opts.processes > 1
+    return server
+
+
+def serve(opts, slot=None, listener=None, stats_fd=None):
+    """ Set up the shared state and run the proxy service, restarting it when it fails.
+    :param slot: Number of the worker process, None if there's no supervisor
+    :param listener: A listening socket inherited from the supervisor
+    :param stats_fd: A pipe to push the counters to the supervisor
+    """
+    global upstream_pool, resolver, tunnel_reactor, response_cache, collapser, timeouts, proxy_server, rule_file, \
+        parents, shaper, buffer_pool, compressor
+    if slot is not None:
+        # The writer threads of the supervisor are gone in the forked process
+        start_logging(opts)
+    upstream_pool = UpstreamPool(opts.pool_per_host, opts.pool_total, opts.pool_idle)
+    buffer_pool = BufferPool(opts.buffer_pool * 1024 * 1024)
+    resolver = DnsCache(opts.dns_ttl, opts.dns_negative_ttl,
+                        resolve=HostsResolver(opts.dns_hosts) if opts.dns_hosts else system_resolve)
+    SocketTunnel.USE_SPLICE = not opts.no_splice
+    SocketTunnel.IDLE_TIMEOUT = opts.tunnel_idle or None
+    timeouts = Timeouts(opts.connect_timeout, opts.header_timeout, opts.body_timeout, opts.keep_alive_timeout)
+    disk = None
+    if opts.disk_cache:
+        # Worker processes don't share the segment files
+        directory = opts.disk_cache if slot is None else os.path.join(opts.disk_cache, "worker-%d" % slot)
+        disk = DiskCache(directory, opts.disk_cache_size * 1024 * 1024, opts.disk_segment * 1024 * 1024,
+                         opts.disk_object_max * 1024 * 1024)
+    if opts.cache_size > 0 or disk is not None:
+        response_cache = ResponseCache(opts.cache_size * 1024 * 1024, opts.cache_object_max * 1024, disk)
+    if opts.collapse_window > 0:
+        collapser = RequestCollapser(opts.collapse_window, opts.collapse_readers)
+    if opts.rules:
+        rule_file = RuleFile(opts.rules, opts.rules_check)
+        rule_file.start()
+    if opts.parent:
+        parents = ParentPool(opts.parent, opts.parent_failures, opts.parent_eject)
+    if opts.client_rate > 0 or opts.total_rate > 0:
+        # The processes share the total rate, a client's connections may be spread over them
+        shaper = Shaper(opts.client_rate * 1024, opts.total_rate * 1024 / max(opts.processes, 1))
+    if opts.gzip:
+        compressor = Compressor(opts.gzip_min, opts.gzip_cpu, opts.gzip_level)
+    if stats_fd is not None:
+        t = threading.Thread(target=push_stats, args=(stats_fd, max(opts.stats_interval, 1) / 2.0))
+        t.daemon = True
+        t.start()
+    elif opts.stats_interval > 0:
+        t = threading.Thread(target=report_stats, args=(opts.stats_interval,))
+        t.daemon = True
+        t.start()
+    if slot is None and opts.admin_port > 0:
+        AdminServer((opts.admin_addr, opts.admin_port), collect_stats).start()
+    if opts.tunnel_reactors > 0 and hasattr(select, "epoll"):
+        tunnel_reactor = TunnelReactor(opts.tunnel_reactors, opts.tunnel_idle or None)
+        tunnel_reactor.start()
+
+    backoff = Backoff()
     while True:
-        server = ThreadingServer((addr, port), HttpProxyHandler)
-        server.run()
+        proxy_server = create_server(opts, listener)
+        proxy_server.run()
 
-        if restart_time > restart_time_upper_bound:
+        restart_time = backoff.next()
+        if restart_time is None:
             error("Too many errors, stop trying to restart service. BYE BYE.")
             exit(1)
 
         warn("Service down!!! Restarting service after %d seconds." % restart_time)
         time.sleep(restart_time)
-        restart_time += 3
     exit(0)
 
 
+def main():
+    global LOG_LEVEL
+    opts = parse_args(sys.argv[1:])
+    LOG_LEVEL = opts.log_level
+    start_logging(opts)
+    atexit.register(flush_log)
+    if opts.engine == "epoll":
+        if not hasattr(select, "epoll"):
+            warn("epoll is not available on this platform, falling back to the thread engine.")
+            opts.engine = "thread"
+        else:
+            raise_fd_limit()
+    if opts.processes > 1 and hasattr(os, "fork"):
+        Supervisor(opts, serve).run()
+        return
+    opts.processes = 1
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    serve(opts)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# seal-test - unit tests for seal-server
+#   Run with: python seal-test.py [-v]
+#   The tests use local sockets and stand-ins only, no network access is needed.
+
+import os
+import imp
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+seal = imp.load_source("seal_server", os.path.join(HERE, "seal-server.py"))
+bench = imp.load_source("seal_bench", os.path.join(HERE, "seal-bench.py"))
+
+
+def origin(response):
+    """ Start a seal-bench origin stand-in answering every request with response. """
+    o = bench.Origin()
+    o.response = response
+    o.start()
+    return o
+
+
+def closing_origin(response):
+    """ Start an origin that answers each connection once with response, then closes it.
+    :return: The port it listens on
+    """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(16)
+
+    def loop():
+        while True:
+            conn = sock.accept()[0]
+            data = ""
+            while "\r\n\r\n" not in data:
+                data += conn.recv(4096)
+            conn.sendall(response)
+            conn.close()
+    t = threading.Thread(target=loop)
+    t.daemon = True
+    t.start()
+    return sock.getsockname()[1]
+
+
+class Proxy:
+    """ A seal-server process, with its admin port to read the counters. """
+    def __init__(self, *args):
+        self.admin = bench.free_port()
+        self.process, self.port = bench.start_proxy("thread", ["--admin-port", str(self.admin)] + list(args))
+
+    def connect(self):
+        conn = socket.create_connection(("127.0.0.1", self.port))
+        conn.settimeout(10)
+        return conn
+
+    def stats(self):
+        conn = socket.create_connection(("127.0.0.1", self.admin))
+        conn.sendall("GET /stats HTTP/1.0\r\n\r\n")
+        data = ""
+        while True:
+            d = conn.recv(65536)
+            if not d:
+                break
+            data += d
+        conn.close()
+        return json.loads(data.split("\r\n\r\n", 1)[1])
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def read_until_close(conn):
+    data = ""
+    while True:
+        d = conn.recv(65536)
+        if not d:
+            return data
+        data += d
+
+
+class UpstreamPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.peers = []
+
+    def tearDown(self):
+        for conn in self.peers:
+            conn.close()
+
+    def connection(self):
+        """ Get one end of a connected pair, the other end is kept open for the test. """
+        conn, peer = socket.socketpair()
+        self.peers.append(peer)
+        return conn
+
+    def expire(self, pool):
+        # Let the next call scan for expired connections, the scan runs at most once per second
+        pool.next_expire = 0
+
+    def test_per_host_limit_of_one(self):
+        pool = seal.UpstreamPool(max_per_host=1, max_total=8, idle_timeout=30.0)
+        first, second = self.connection(), self.connection()
+        pool.release(("h", 80), first)
+        pool.release(("h", 80), second)
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool.stats()["evicted"], 1)
+        self.assertIs(pool.acquire(("h", 80)), second)
+        self.assertEqual(pool.stats()["hosts"], 0)
+
+    def test_per_host_limit_of_one_expires(self):
+        pool = seal.UpstreamPool(max_per_host=1, max_total=8, idle_timeout=0.0)
+        pool.release(("h", 80), self.connection())
+        pool.release(("h", 80), self.connection())
+        self.expire(pool)
+        self.assertIsNone(pool.acquire(("h", 80)))
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.stats()["hosts"], 0)
+
+    def test_full_pool_evicts_only_connection_of_same_host(self):
+        pool = seal.UpstreamPool(max_per_host=8, max_total=1, idle_timeout=30.0)
+        first, second = self.connection(), self.connection()
+        pool.release(("h", 80), first)
+        pool.release(("h", 80), second)
+        self.assertEqual(len(pool), 1)
+        self.assertIs(pool.acquire(("h", 80)), second)
+        self.assertIsNone(pool.acquire(("h", 80)))
+
+    def test_full_pool_evicts_oldest_host(self):
+        pool = seal.UpstreamPool(max_per_host=8, max_total=2, idle_timeout=30.0)
+        a, b, c = self.connection(), self.connection(), self.connection()
+        pool.release(("a", 80), a)
+        pool.release(("b", 80), b)
+        pool.release(("c", 80), c)
+        self.assertEqual(len(pool), 2)
+        self.assertIsNone(pool.acquire(("a", 80)))
+        self.assertIs(pool.acquire(("b", 80)), b)
+        self.assertIs(pool.acquire(("c", 80)), c)
+
+    def test_full_pool_expires(self):
+        pool = seal.UpstreamPool(max_per_host=8, max_total=1, idle_timeout=0.0)
+        pool.release(("h", 80), self.connection())
+        pool.release(("h", 80), self.connection())
+        self.expire(pool)
+        self.assertIsNone(pool.acquire(("h", 80)))
+        self.assertEqual(len(pool), 0)
+
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_journal_keeps_any_bytes(self):
+        cache = seal.DiskCache(self.directory, 1024 * 1024, 256 * 1024)
+        request = seal.HttpRequest()
+        request.set_request("http://h/caf\xe9")
+        response = seal.HttpResponse()
+        response.set_status_line("HTTP/1.1 200 OK")
+        response.add_header_line("X-A: caf\xe9")
+        fill = cache.fill()
+        fill.write("body")
+        fill.commit("http://h/caf\xe9", request, response, time.time())
+        self.assertEqual(len(cache.writable), 1)
+        cache.journal.close()
+
+        cache = seal.DiskCache(self.directory, 1024 * 1024, 256 * 1024)
+        entry = cache.lookup("http://h/caf\xe9", request)
+        self.assertIsNotNone(entry)
+        self.assertEqual(entry.headers.get("X-A"), "caf\xe9")
+        cache.journal.close()
+
+    def test_hit_larger_than_socket_buffer(self):
+        size = 8 * 1024 * 1024
+        o = origin("HTTP/1.1 200 OK\r\nCache-Control: max-age=600\r\nContent-Length: %d\r\n\r\n%s"
+                   % (size, "x" * size))
+        proxy = Proxy("--disk-cache", self.directory)
+        try:
+            for i in range(0, 2):
+                conn = proxy.connect()
+                conn.sendall("GET http://127.0.0.1:%d/big HTTP/1.1\r\nHost: x\r\nProxy-Connection: close\r\n\r\n"
+                             % o.port)
+                # Let the socket buffers fill up before reading
+                time.sleep(0.5)
+                data = read_until_close(conn)
+                conn.close()
+                self.assertEqual(len(data.split("\r\n\r\n", 1)[1]), size)
+            self.assertEqual(proxy.stats()["disk"]["hits"], 1)
+        finally:
+            proxy.stop()
+
+
+class ProxyTest(unittest.TestCase):
+    def test_body_until_close(self):
+        port = closing_origin("HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n" + "y" * 100000)
+        proxy = Proxy()
+        try:
+            conn = proxy.connect()
+            conn.sendall("GET http://127.0.0.1:%d/ HTTP/1.1\r\nHost: x\r\n\r\n" % port)
+            data = read_until_close(conn)
+            conn.close()
+            self.assertEqual(data.split("\r\n\r\n", 1)[1], "y" * 100000)
+            self.assertEqual(proxy.stats()["pool"]["released"], 0)
+        finally:
+            proxy.stop()
+
+    def test_pipelined_requests_count_at_parent(self):
+        o = origin("HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        proxy = Proxy("--parent", "127.0.0.1:%d" % o.port)
+        try:
+            conn = proxy.connect()
+            conn.sendall("GET http://h/ HTTP/1.1\r\nHost: h\r\n\r\n" * 3)
+            buf = ""
+            for i in range(0, 3):
+                buf = bench.read_response(conn, buf)
+            conn.close()
+            time.sleep(0.2)
+            stats = proxy.stats()["parents"]
+            self.assertEqual(stats["requests"], 3)
+            self.assertEqual(stats["outstanding"], 0)
+        finally:
+            proxy.stop()
+
+
+class ServerTest(unittest.TestCase):
+    def test_inherited_listener_survives_a_failure(self):
+        listener = seal.listen_socket(("127.0.0.1", 0), 16)
+        server = seal.ThreadingServer(listener.getsockname(), seal.HttpProxyHandler, 1, 1, "close")
+        server.listener = listener
+
+        def fail(conn):
+            conn.close()
+            raise IOError("handler failure")
+        server._admit = fail
+        socket.create_connection(listener.getsockname()).close()
+        server.run()
+        # Still listening, for the restarted service
+        socket.create_connection(listener.getsockname()).close()
+        listener.close()
+
+
+class CompressorTest(unittest.TestCase):
+    def test_types_are_counted_by_family(self):
+        family = seal.Compressor.family
+        self.assertEqual(family("text/html"), "text/*")
+        self.assertEqual(family("text/x-anything-an-origin-says"), "text/*")
+        self.assertEqual(family("application/json"), "application/json")
+        self.assertEqual(family("application/vnd.a+json"), "*+json")
+        self.assertEqual(family("image/svg+xml"), "image/svg+xml")
+
+
+if __name__ == "__main__":
+    unittest.main()